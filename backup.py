@@ -0,0 +1,403 @@
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+# linux ioctl that clones a file's extents, supported by btrfs, xfs and a few others
+FICLONE = 0x40049409
+
+
+class BackupAborted(Exception):
+    pass
+
+
+def is_sqlite(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except OSError:
+        return False
+
+
+def fingerprint(path):
+    # a commit touches the -wal file in WAL mode and the database itself otherwise, so comparing both
+    # is enough to tell an unchanged database without opening it
+    state = []
+    for name in (path, path + '-wal'):
+        try:
+            stat = os.stat(name)
+            state.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            state.append(None)
+    return state
+
+
+class Throttle(object):
+    """Called with the size of everything read, sleeps to keep the average under `rate` bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.consumed = 0
+
+    def __call__(self, size):
+        self.consumed += size
+        ahead = self.consumed / float(self.rate) - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class OnlineBackup(object):
+    """
+    Consistent copy of a live SQLite database through the sqlite3 backup API.
+
+    Pages are copied `pages` at a time with a short pause in between, so the server writing to the
+    database only ever waits for one step. SQLite restarts the copy when another connection writes
+    in the middle of it; after `max_restarts` of those the rest is copied in a single step.
+    """
+    pages = 256
+    pause = 0.005
+    max_restarts = 3
+
+    def __init__(self, source, destination, progress=None, pages=None, pause=None, throttle=None):
+        self.source = source
+        self.destination = destination
+        self.progress = progress
+        self.throttle = throttle
+        self.page_size = 4096
+        self.pages = pages or self.pages
+        self.pause = self.pause if pause is None else pause
+        self.cancelled = False
+        self.restarts = 0
+        self.remaining = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        if not os.path.isfile(self.source):
+            raise IOError('%s does not exist.' % self.source)
+        partial = self.destination + '.part'
+        if os.path.exists(partial):
+            os.remove(partial)
+        try:
+            if is_sqlite(self.source):
+                self.copy_database(partial)
+            else:
+                # not a database, nothing can change it underneath us in a way the backup API would catch
+                shutil.copyfile(self.source, partial)
+            os.replace(partial, self.destination)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return self.destination
+
+    def copy_database(self, partial):
+        source = sqlite3.connect(self.source, timeout=30)
+        target = sqlite3.connect(partial)
+        try:
+            self.page_size = source.execute('PRAGMA page_size').fetchone()[0]
+            try:
+                source.backup(target, pages=self.pages, progress=self.step)
+            except BackupAborted:
+                if self.cancelled:
+                    raise
+                if self.throttle:
+                    self.copy_pinned(source, target)
+                else:
+                    # writes keep restarting the stepped copy, take it all while holding the read lock
+                    source.backup(target, pages=-1)
+            if self.progress:
+                self.progress(1, 1)
+        finally:
+            target.close()
+            source.close()
+
+    def copy_pinned(self, source, target):
+        # a single step would read the whole database at full speed. In WAL mode a read transaction
+        # held on the source pins its snapshot without blocking writers, so the stepped, throttled copy
+        # can't be restarted any more. Otherwise it would hold off writers for the whole copy.
+        if source.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal':
+            raise BackupAborted('The database is too busy to back up without slowing it down, try again later.')
+        source.execute('BEGIN')
+        try:
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            self.remaining = None
+            self.restarts = 0
+            source.backup(target, pages=self.pages, progress=self.step)
+        finally:
+            source.rollback()
+
+    def step(self, status, remaining, total):
+        if self.cancelled:
+            raise BackupAborted('Backup cancelled.')
+        if self.remaining is not None and remaining > self.remaining:
+            self.restarts += 1
+            if self.restarts > self.max_restarts:
+                raise BackupAborted('Too many restarts.')
+        if self.throttle:
+            copied = (total if self.remaining is None else self.remaining) - remaining
+            self.throttle(max(0, copied) * self.page_size)
+        self.remaining = remaining
+        if self.progress:
+            self.progress(total - remaining, total)
+        if self.pause:
+            time.sleep(self.pause)
+
+
+def connect_readonly(path):
+    return sqlite3.connect(pathlib.Path(os.path.abspath(path)).as_uri() + '?mode=ro', uri=True)
+
+
+def migration_state(path):
+    """The newest applied Django migration in the database at `path` and how many are applied."""
+    if not is_sqlite(path):
+        return ''
+    try:
+        connection = connect_readonly(path)
+        try:
+            count = connection.execute('SELECT COUNT(*) FROM django_migrations').fetchone()[0]
+            latest = connection.execute('SELECT app, name FROM django_migrations ORDER BY applied DESC, id DESC '
+                                        'LIMIT 1').fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return ''
+    return '%s.%s (%d applied)' % (latest[0], latest[1], count) if latest else 'none applied'
+
+
+def quick_check(path):
+    """Raise IOError unless `PRAGMA quick_check` passes on the database at `path`."""
+    if not is_sqlite(path):
+        raise IOError('%s is not a SQLite database.' % path)
+    connection = connect_readonly(path)
+    try:
+        result = [row[0] for row in connection.execute('PRAGMA quick_check')]
+    except sqlite3.DatabaseError as e:
+        raise IOError('%s failed the integrity check: %s' % (path, e))
+    finally:
+        connection.close()
+    if result != ['ok']:
+        raise IOError('%s failed the integrity check: %s' % (path, '; '.join(result[:5])))
+
+
+class StagedRestore(object):
+    """
+    Puts a checked copy of a backup next to the database it replaces, so that replacing it is just a
+    rename that can happen while the service is briefly stopped.
+    """
+    chunk = 1024 * 1024
+
+    def __init__(self, target, progress=None):
+        self.target = target
+        self.progress = progress
+        self.staged = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def step(self, done, total):
+        if self.cancelled:
+            raise BackupAborted('Restore cancelled.')
+        if self.progress:
+            self.progress(done, total)
+
+    def create(self):
+        fd, self.staged = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.target)), prefix='.restore-')
+        return os.fdopen(fd, 'wb')
+
+    def stage_file(self, source):
+        # a backup file doesn't change, so checking it while it is copied checks the copy as well
+        errors = []
+        checker = threading.Thread(target=self.run_check, args=(source, errors), name='quick-check', daemon=True)
+        checker.start()
+        total = os.path.getsize(source)
+        done = 0
+        try:
+            with open(source, 'rb') as src, self.create() as f:
+                while True:
+                    data = src.read(self.chunk)
+                    if not data:
+                        break
+                    f.write(data)
+                    done += len(data)
+                    self.step(done, total)
+                f.flush()
+                os.fsync(f.fileno())
+            checker.join()
+            if errors:
+                raise errors[0]
+        except BaseException:
+            self.discard()
+            raise
+        return self.staged
+
+    def stage_snapshot(self, repository, snapshot):
+        try:
+            with self.create() as f:
+                repository.extract(snapshot, f, self.step)
+                f.flush()
+                os.fsync(f.fileno())
+            # the chunks are only assembled here, so this check can't overlap with the copy
+            quick_check(self.staged)
+        except BaseException:
+            self.discard()
+            raise
+        return self.staged
+
+    def run_check(self, path, errors):
+        try:
+            quick_check(path)
+        except IOError as e:
+            errors.append(e)
+
+    def swap(self):
+        os.replace(self.staged, self.target)
+        self.staged = None
+        # a -wal left from the old database would be replayed into the restored one. Only removed once
+        # the replace went through, the old database still needs it otherwise, and with the service
+        # stopped nothing opens the database in between.
+        for suffix in ('-wal', '-shm', '-journal'):
+            if os.path.exists(self.target + suffix):
+                os.remove(self.target + suffix)
+
+    def discard(self):
+        if self.staged and os.path.exists(self.staged):
+            os.remove(self.staged)
+        self.staged = None
+
+
+# directory -> whether the filesystem under it can clone, probed once per run
+reflink_support = {}
+
+
+def supports_reflink(directory):
+    if directory not in reflink_support:
+        try:
+            with tempfile.NamedTemporaryFile(dir=directory, prefix='.reflink-') as f:
+                f.write(b'probe')
+                f.flush()
+                reflink(f.name, f.name + '.clone')
+                os.remove(f.name + '.clone')
+            reflink_support[directory] = True
+        except OSError:
+            reflink_support[directory] = False
+    return reflink_support[directory]
+
+
+def reflink(source, destination):
+    """Copy on write clone of `source`, raises OSError where the platform or filesystem can't do it."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError('Reflinks are not supported on this platform.')
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+
+
+class RollbackPoints(object):
+    """
+    Snapshots of the database taken right before risky operations, kept beside it in `directory`.
+
+    Where the filesystem supports reflinks a snapshot is a clone taken while writers are held off,
+    which costs milliseconds however large the database is. Elsewhere it falls back to a single step
+    online backup. Only the newest `keep` points are kept.
+    """
+    keep = 5
+
+    def __init__(self, database, directory=None, keep=None):
+        self.database = database
+        self.directory = directory or os.path.join(os.path.dirname(database), '.cockpit-rollback')
+        self.keep = keep or self.keep
+
+    def can_clone(self):
+        os.makedirs(self.directory, exist_ok=True)
+        return supports_reflink(self.directory)
+
+    def take(self, reason, fallback=True, timeout=30):
+        """
+        Take a point and return it, or None when it can't be cloned, or writers weren't held off within
+        `timeout` seconds, and `fallback` is off.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.time()
+        point_id = time.strftime('%Y%m%d-%H%M%S', time.localtime(started)) + '-%03d' % (started % 1 * 1000)
+        path = os.path.join(self.directory, point_id + '.sqlite3')
+        try:
+            self.clone(path, timeout)
+            method = 'reflink'
+        except (OSError, sqlite3.OperationalError):
+            if os.path.exists(path):
+                os.remove(path)
+            if not fallback:
+                return None
+            OnlineBackup(self.database, path, pages=-1, pause=0).run()
+            method = 'backup'
+        point = {'id': point_id, 'reason': reason, 'created': started, 'method': method,
+                 'duration': time.time() - started, 'size': os.path.getsize(path), 'path': path}
+        with open(os.path.join(self.directory, point_id + '.json'), 'w') as f:
+            json.dump(point, f)
+        self.prune()
+        return point
+
+    def clone(self, path, timeout=30):
+        if not is_sqlite(self.database):
+            return reflink(self.database, path)
+        connection = sqlite3.connect(self.database, timeout=timeout, isolation_level=None)
+        try:
+            # no commit can land while the database and its -wal are cloned, so the pair is consistent
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                reflink(self.database, path)
+                if os.path.exists(self.database + '-wal'):
+                    shutil.copyfile(self.database + '-wal', path + '-wal')
+            finally:
+                connection.execute('ROLLBACK')
+        finally:
+            connection.close()
+        if os.path.exists(path + '-wal'):
+            # fold the copied log into the clone so the point is a single file
+            clone = sqlite3.connect(path)
+            try:
+                clone.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            finally:
+                clone.close()
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def points(self):
+        """Rollback points, newest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        points = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    point = json.load(f)
+            except (OSError, ValueError):
+                continue
+            point['path'] = os.path.join(self.directory, point['id'] + '.sqlite3')
+            if os.path.exists(point['path']):
+                points.append(point)
+        return points
+
+    def prune(self):
+        for point in self.points()[self.keep:]:
+            for path in (point['path'], os.path.join(self.directory, point['id'] + '.json')):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,254 @@
+import os
+import urllib.request
+
+from PyQt5 import QtNetwork
+from PyQt5.QtCore import QCoreApplication, Qt, pyqtSignal, QUrl
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWebKit import QWebSettings
+from PyQt5.QtWebKitWidgets import QWebView, QWebPage, QWebInspector
+from PyQt5.QtWidgets import QMessageBox, QMainWindow, QAction, QVBoxLayout, QFileDialog, QProgressBar, QShortcut, \
+    QDialog, QStyle, QLineEdit
+
+from utils import to_pycookiejar
+
+
+class WebPage(QWebPage):
+    console_message = pyqtSignal(str, int, str)
+
+    def javaScriptConsoleMessage(self, msg, line, source):
+        self.console_message.emit(msg, line, source)
+
+
+class WebView(QWebView):
+    def __init__(self, *args, **kwargs):
+        super(WebView, self).__init__(*args, **kwargs)
+        self._page = WebPage()
+        self._page.setForwardUnsupportedContent(True)
+
+        self.setPage(self._page)
+
+    def contextMenuEvent(self, event):
+        pass
+
+
+class WebBrowser(QMainWindow):
+    printer = None
+    downloading = False
+
+    def i(self, ico):
+        return self.style().standardIcon(ico)
+
+    def __init__(self, base):
+        QMainWindow.__init__(self)
+        self.base = base
+        self.setWindowIcon(self.base.app_icon)
+        self.setWindowTitle(self.base.settings.get_title())
+        QWebSettings.globalSettings().setAttribute(QWebSettings.DeveloperExtrasEnabled, True)
+
+        self.pbar = QProgressBar()
+        self.pbar.setMaximumWidth(120)
+        self.wb = WebView(loadProgress=self.pbar.setValue, loadFinished=self.load_finished,
+                          loadStarted=self.load_started,
+                          titleChanged=self.change_title)
+        self.setCentralWidget(self.wb)
+        self.wb.page().unsupportedContent.connect(self.download)
+        # self.wb.page().downloadRequested.connect(lambda req: self.download(self.wb.page().networkAccessManager().get(req)))
+
+        self.cookies = QtNetwork.QNetworkCookieJar(QCoreApplication.instance())
+        self.wb.page().networkAccessManager().setCookieJar(self.cookies)
+        self.cookies.setAllCookies(QtNetwork.QNetworkCookie.parseCookies(self.base.settings.get_cookies()))
+
+        self.tb = self.addToolBar('Main Toolbar')
+        for a in (QWebPage.Back, QWebPage.Forward, QWebPage.Reload):
+            self.tb.addAction(self.wb.pageAction(a))
+        home_action = QAction(self.i(QStyle.SP_DirHomeIcon), 'Home', self)
+        home_action.triggered.connect(self.load)
+        self.tb.addAction(home_action)
+        self.tb.addSeparator()
+        print_action = QAction(QIcon.fromTheme('document-print'), 'Print', self)
+        # print_action.setShortcut('Ctrl+P')
+        print_action.triggered.connect(self.print_dialog)
+        self.tb.addAction(print_action)
+        print_preview_action = QAction(QIcon.fromTheme('document-print-preview'), 'Print Preview', self)
+        print_preview_action.triggered.connect(self.print_preview)
+        self.tb.addAction(print_preview_action)
+        print_pdf_action = QAction(QIcon.fromTheme('document-save'), 'Save as PDF', self)
+        print_pdf_action.triggered.connect(self.print_pdf)
+        self.tb.addAction(print_pdf_action)
+        self.tb.addSeparator()
+
+        self.search = QLineEdit(
+            returnPressed=lambda: self.wb.findText(self.search.text(), QWebPage.FindWrapsAroundDocument))
+        self.search.setPlaceholderText('Search')
+        QShortcut("Ctrl+F", self, activated=self.toggle_search_focus)
+        QShortcut("Esc", self, activated=self.remove_search_focus)
+        self.search.setMaximumWidth(250)
+        self.search_action = self.tb.addWidget(self.search)
+        # self.hide_search()
+
+        QShortcut("Ctrl+Q", self, activated=self.close)
+        QShortcut("Ctrl+W", self, activated=self.close)
+        QShortcut("F11", self, activated=self.switch_full_screen)
+        QShortcut("Backspace", self, activated=lambda: self.wb.triggerPageAction(QWebPage.Back))
+        QShortcut("Alt+Left", self, activated=lambda: self.wb.triggerPageAction(QWebPage.Back))
+        QShortcut("Alt+Right", self, activated=lambda: self.wb.triggerPageAction(QWebPage.Forward))
+        QShortcut("Ctrl+R", self, activated=lambda: self.wb.triggerPageAction(QWebPage.Reload))
+        QShortcut("Ctrl+Shift+R", self, activated=lambda: self.wb.triggerPageAction(QWebPage.ReloadAndBypassCache))
+        QShortcut("Ctrl+=", self, activated=lambda: self.wb.setZoomFactor(self.wb.zoomFactor() + .2))
+        QShortcut("Ctrl+-", self, activated=lambda: self.wb.setZoomFactor(self.wb.zoomFactor() - .2))
+        QShortcut("Ctrl+0", self, activated=lambda: self.wb.setZoomFactor(1))
+        QShortcut("Ctrl+P", self, activated=self.print_dialog)
+        QShortcut("Ctrl+Shift+P", self, activated=self.print_preview)
+        QShortcut("Ctrl+Shift+E", self, activated=self.print_pdf)
+        QShortcut("Ctrl+Shift+J", self, activated=self.show_dev_tools)
+        QShortcut("Ctrl+Shift+Q", self, activated=self.base.quit)
+
+        self.wb.page().console_message.connect(self.console_message)
+        self.wb.page().printRequested.connect(self.print_dialog)
+        self.wb.settings().setAttribute(QWebSettings.PluginsEnabled, True)
+
+    def download(self, reply):
+        self.downloading = True
+        destination = QFileDialog.getSaveFileName(self, "Save File",
+                                                  os.path.expanduser(os.path.join('~', str(reply.url().path()).split('/')[-1])))
+        if destination[0]:
+            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(to_pycookiejar(self.cookies)))
+            try:
+                with opener.open(reply.url().toString()) as response:
+                    with open(destination[0], 'wb') as f:
+                        f.write(response.read())
+            except Exception as e:
+                QMessageBox.critical(None, 'Saving Failed!', str(e), QMessageBox.Ok)
+
+    def init_printer(self):
+        # the print support module is only loaded once something gets printed
+        from PyQt5.QtPrintSupport import QPrinter, QPrinterInfo
+        if not self.printer:
+            self.printer = QPrinter(QPrinterInfo.defaultPrinter(), QPrinter.HighResolution)
+            self.printer.setOrientation(QPrinter.Portrait)
+            self.printer.setPaperSize(QPrinter.A4)
+        return self.printer
+
+    def print(self):
+        self.wb.print_(self.printer)
+
+    def print_pdf(self):
+        from PyQt5.QtPrintSupport import QPrinter
+        self.init_printer()
+        self.printer.setOutputFormat(QPrinter.PdfFormat)
+        chosen_file = QFileDialog.getSaveFileName(self, 'Save file', '', '.pdf', self.wb.title())
+        file_name = ''.join(chosen_file)
+        self.printer.setOutputFileName(file_name)
+        self.wb.print_(self.printer)
+
+    def print_dialog(self):
+        from PyQt5.QtPrintSupport import QPrintDialog
+        dialog = QPrintDialog(self.init_printer())
+        dialog.setWindowTitle('Print')
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        self.print()
+
+    def print_preview(self):
+        from PyQt5.QtPrintSupport import QPrintPreviewDialog
+        dialog = QPrintPreviewDialog(self.init_printer())
+        dialog.setWindowState(Qt.WindowMaximized)
+        dialog.paintRequested.connect(self.print)
+        dialog.setWindowFlags(
+            Qt.CustomizeWindowHint | Qt.WindowTitleHint | Qt.WindowMinMaxButtonsHint | Qt.WindowCloseButtonHint | Qt.WindowContextHelpButtonHint)
+        dialog.exec()
+
+    def show_dev_tools(self):
+        self.inspector = QWebInspector(self)
+        self.inspector.setPage(self.wb.page)
+        self.dev_tools = QDialog()
+        self.dev_tools_layout = QVBoxLayout()
+        self.dev_tools_layout.addWidget(self.inspector)
+        self.dev_tools.setLayout(self.dev_tools_layout)
+        self.dev_tools.setModal(False)
+        self.dev_tools.show()
+        self.dev_tools.activateWindow()
+        QShortcut("Ctrl+W", self.dev_tools, activated=self.dev_tools.close)
+
+    def console_message(self, msg, line, source):
+        self.base.cockpit.console_tab.console.add_line('%s line %d: %s' % (source, line, msg))
+
+    def load_started(self):
+        self.pbar.show()
+        self.pbar_action = self.tb.addWidget(self.pbar)
+
+    def load_finished(self, result):
+        self.pbar.hide()
+        self.tb.removeAction(self.pbar_action)
+        self.save_cookies()
+        if not self.downloading and not result:
+            self.wb.page().mainFrame().setHtml("<html><head><title>Error loading page</title></head>\
+         <body><h1>Error loading " + self.base.settings.get_local_url() + "</h2></body> </html>")
+        self.downloading = False
+
+    def toggle_search(self):
+        if self.search.isVisible():
+            self.hide_search()
+        else:
+            self.show_search()
+
+    def toggle_search_focus(self):
+        if self.search.hasFocus():
+            self.wb.setFocus()
+        else:
+            self.search.setFocus()
+
+    def remove_search_focus(self):
+        self.wb.setFocus()
+
+    def show_search(self):
+        self.search.show()
+        self.search_action = self.tb.addWidget(self.search)
+        self.search.setFocus()
+
+    def hide_search(self):
+        self.search.hide()
+        self.tb.removeAction(self.search_action)
+
+    def switch_full_screen(self):
+        if self.isFullScreen():
+            self.showMaximized()
+        else:
+            self.showFullScreen()
+
+    def show_window(self):
+        self.load()
+        try:
+            from win32gui import SetWindowPos
+            import win32con
+
+            SetWindowPos(self.winId(),
+                         win32con.HWND_TOPMOST,
+                         # = always on top. only reliable way to bring it to the front on windows
+                         0, 0, 0, 0,
+                         win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
+            SetWindowPos(self.winId(),
+                         win32con.HWND_NOTOPMOST,  # disable the always on top, but leave window at its top position
+                         0, 0, 0, 0,
+                         win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
+        except ImportError:
+            pass
+
+        self.raise_()
+        self.showMaximized()
+        self.setWindowState(self.windowState() & ~Qt.WindowMinimized | Qt.WindowActive)
+        self.activateWindow()
+
+    def load(self, url=None):
+        url = url or self.base.settings.get_local_url()
+        self.wb.load(QUrl(url))
+
+    def change_title(self):
+        self.setWindowTitle(self.wb.title() + ' | ' + self.base.settings.get_title())
+
+        # def closeEvent(self, event):
+        #     event.ignore()
+        #     self.hide()
+
+    def save_cookies(self):
+        self.base.settings.set_cookies([str(c.toRawForm(), encoding='utf-8') + "\n" for c in self.cookies.allCookies()])
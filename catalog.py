@@ -0,0 +1,161 @@
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backup import BackupAborted, is_sqlite, migration_state
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS backups (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    created REAL NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    source TEXT,
+    migration TEXT,
+    duration REAL,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS backups_created ON backups (created);
+'''
+COLUMNS = ('id', 'kind', 'path', 'created', 'size', 'sha256', 'source', 'migration', 'duration', 'mtime_ns')
+
+
+def file_sha256(path, block=1024 * 1024, cancelled=None):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            if cancelled and cancelled():
+                raise BackupAborted('Scan cancelled.')
+            data = f.read(block)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def snapshot_entry(snapshot):
+    return {'id': 'snapshot:' + snapshot.id, 'kind': 'snapshot', 'path': snapshot.path, 'created': snapshot.created,
+            'size': snapshot.size, 'sha256': snapshot.sha256, 'source': snapshot.source,
+            'migration': snapshot.manifest.get('migration', ''), 'duration': snapshot.manifest.get('duration'),
+            'mtime_ns': None}
+
+
+def file_entry(path, known=None, cancelled=None):
+    stat = os.stat(path)
+    if known and known['mtime_ns'] == stat.st_mtime_ns and known['size'] == stat.st_size:
+        # hashing is the expensive part, an untouched file keeps what we had
+        return known
+    return {'id': 'file:' + path, 'kind': 'file', 'path': path, 'created': stat.st_mtime, 'size': stat.st_size,
+            'sha256': file_sha256(path, cancelled=cancelled), 'source': path, 'migration': migration_state(path), 'duration': None,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+class Catalog(object):
+    """
+    SQLite index of every backup (repository snapshots and database files lying in the backup folder),
+    so listing and filtering them never touches the backups themselves.
+    """
+    workers = 4
+
+    def __init__(self, path):
+        self.path = path
+        self.cancelled = False
+
+    def cancel(self):
+        # checked between files and between the blocks of a file being hashed
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def connect(self):
+        # a connection per call, the catalog is used from the GUI thread and the backup workers
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        connection.executescript(SCHEMA)
+        return connection
+
+    def add(self, *entries):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO backups VALUES (%s)' % ', '.join('?' * len(COLUMNS)),
+                                       [tuple(entry[column] for column in COLUMNS) for entry in entries])
+        finally:
+            connection.close()
+
+    def remove(self, ids):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany('DELETE FROM backups WHERE id = ?', [(backup_id,) for backup_id in ids])
+        finally:
+            connection.close()
+
+    def get(self, backup_id):
+        connection = self.connect()
+        try:
+            row = connection.execute('SELECT * FROM backups WHERE id = ?', (backup_id,)).fetchone()
+        finally:
+            connection.close()
+        return dict(row) if row else None
+
+    def query(self, text='', limit=500):
+        """Newest first, `text` is matched against paths, checksums and migration names."""
+        sql = 'SELECT * FROM backups'
+        params = []
+        if text:
+            sql += ' WHERE path LIKE ? OR source LIKE ? OR sha256 LIKE ? OR migration LIKE ? OR kind = ?'
+            like = '%' + text + '%'
+            params = [like, like, text + '%', like, text]
+        sql += ' ORDER BY created DESC LIMIT ?'
+        params.append(limit)
+        connection = self.connect()
+        try:
+            return [dict(row) for row in connection.execute(sql, params)]
+        finally:
+            connection.close()
+
+    def count(self):
+        connection = self.connect()
+        try:
+            return connection.execute('SELECT COUNT(*) FROM backups').fetchone()[0]
+        finally:
+            connection.close()
+
+    def rebuild(self, repository, directory):
+        """Scan the repository and `directory` in parallel and make the catalog match what is there."""
+        started = time.time()
+        known = dict((entry['id'], entry) for entry in self.query(limit=-1))
+        files = []
+        repository_root = os.path.abspath(repository.root) if repository else None
+        for root, dirs, names in os.walk(directory):
+            if repository_root and os.path.abspath(root) == repository_root:
+                dirs[:] = []
+                continue
+            files.extend(os.path.join(root, name) for name in names)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            found = [entry for entry in pool.map(lambda path: self.scan_file(path, known), files) if entry]
+        # listed after the slow part, and checked again right before adding, so a snapshot pruned by a
+        # backup running meanwhile doesn't come back
+        snapshots = [snapshot_entry(snapshot) for snapshot in (repository.snapshots() if repository else [])]
+        entries = [entry for entry in snapshots if os.path.exists(entry['path'])] + found
+        self.add(*entries)
+        seen = set(entry['id'] for entry in entries)
+        self.remove([backup_id for backup_id in known if backup_id not in seen])
+        return len(entries), time.time() - started
+
+    def scan_file(self, path, known):
+        if self.cancelled:
+            raise BackupAborted('Scan cancelled.')
+        try:
+            if not is_sqlite(path):
+                return None
+            return file_entry(path, known.get('file:' + path), self.is_cancelled)
+        except OSError:
+            return None
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import re
+import time
+import urllib.error
+import urllib.request
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+UNSATISFIED_RANGE = re.compile(r'bytes \*/(\d+)')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Download(object):
+    """
+    Streams `url` to `path` in chunks, so memory use doesn't depend on the size of the file.
+
+    The data goes to `path + '.part'` first. An interrupted download is resumed with a Range request
+    (guarded by If-Range, so a file that changed on the server starts over) and the sha256 is
+    computed while streaming, checked against `sha256` when one is given.
+    """
+    chunk = 64 * 1024
+    attempts = 3
+    timeout = 30
+
+    def __init__(self, url, path, sha256=None, progress=None, opener=None):
+        self.url = url
+        self.path = path
+        self.partial = path + '.part'
+        self.state_path = path + '.part.json'
+        self.expected = sha256.lower() if sha256 else None
+        self.progress = progress
+        self.opener = opener or urllib.request.build_opener()
+        self.cancelled = False
+        self.sha256 = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        error = None
+        for attempt in range(self.attempts):
+            try:
+                return self.fetch()
+            except (OSError, urllib.error.URLError, DownloadError) as e:
+                if self.cancelled or isinstance(e, urllib.error.HTTPError) and e.code < 500 and e.code != 408:
+                    raise
+                error = e
+                time.sleep(min(2 ** attempt, 10))
+        raise error
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        with open(self.state_path, 'w') as f:
+            json.dump(state, f)
+
+    def fetch(self):
+        state = self.load_state()
+        offset = os.path.getsize(self.partial) if os.path.exists(self.partial) else 0
+        request = urllib.request.Request(self.url)
+        validator = state.get('etag') or state.get('last_modified')
+        if offset and validator and state.get('url') == self.url:
+            request.add_header('Range', 'bytes=%d-' % offset)
+            request.add_header('If-Range', validator)
+        else:
+            offset = 0
+        try:
+            response = self.opener.open(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # the part already holds everything, left by a kill or cancel right before it was renamed
+            match = UNSATISFIED_RANGE.match(e.headers.get('Content-Range', ''))
+            e.close()
+            if match and int(match.group(1)) == offset:
+                digest = hashlib.sha256()
+                self.hash_part(digest)
+                return self.finish(digest)
+            self.discard()
+            return self.fetch()
+        with response:
+            total = None
+            if response.status == 206:
+                match = CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+                if not match or int(match.group(1)) != offset:
+                    # the part can't be trusted either way, the retry starts from scratch
+                    self.discard()
+                    raise DownloadError('The server resumed at the wrong offset.')
+                total = int(match.group(3)) if match.group(3) != '*' else None
+            else:
+                # a full response, either the first try or the file changed since
+                offset = 0
+                length = response.headers.get('Content-Length')
+                total = int(length) if length and length.isdigit() else None
+            self.save_state({'url': self.url, 'etag': response.headers.get('ETag'),
+                             'last_modified': response.headers.get('Last-Modified')})
+            digest = hashlib.sha256()
+            if offset:
+                # the part already on disk has to be part of the hash
+                self.hash_part(digest)
+            done = offset
+            with open(self.partial, 'ab' if offset else 'wb') as f:
+                while True:
+                    if self.cancelled:
+                        raise DownloadError('Download cancelled.')
+                    data = response.read(self.chunk)
+                    if not data:
+                        break
+                    f.write(data)
+                    digest.update(data)
+                    done += len(data)
+                    if self.progress:
+                        self.progress(done, total or 0)
+        if total is not None and done != total:
+            raise DownloadError('Connection closed after %d of %d bytes.' % (done, total))
+        return self.finish(digest)
+
+    def hash_part(self, digest):
+        with open(self.partial, 'rb') as f:
+            while True:
+                data = f.read(self.chunk)
+                if not data:
+                    break
+                digest.update(data)
+
+    def discard(self):
+        for path in (self.partial, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def finish(self, digest):
+        self.sha256 = digest.hexdigest()
+        if self.expected and self.sha256 != self.expected:
+            self.discard()
+            raise DownloadError('Checksum mismatch, expected %s but got %s.' % (self.expected, self.sha256))
+        os.replace(self.partial, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return self.path
@@ -0,0 +1,233 @@
+import bisect
+import os
+import queue
+import threading
+import time
+
+
+class LogStore(object):
+    """
+    Append-only store for the service output, split into segment files.
+
+    Every segment `<prefix>-<start>.log` has a sidecar `<prefix>-<start>.idx` with one
+    "<timestamp> <byte offset>" line per index_interval, so jumping to a point in time
+    is a bisect plus a seek. Writes happen on a background thread.
+    """
+    max_bytes = 10 * 1024 * 1024
+    max_age = 24 * 60 * 60
+    max_segments = 50
+    index_interval = 1.0
+    page_size = 64 * 1024
+
+    def __init__(self, directory, prefix='server', max_bytes=None, max_age=None, max_segments=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes or self.max_bytes
+        self.max_age = max_age or self.max_age
+        self.max_segments = max_segments or self.max_segments
+        os.makedirs(self.directory, exist_ok=True)
+        self.indexes = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='log-store', daemon=True)
+        self.thread.start()
+
+    # writing, only ever called from the background thread except append/close
+
+    def append(self, lines, timestamp=None):
+        if lines:
+            self.queue.put((timestamp or time.time(), lines))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        log_file = idx_file = None
+        started = last_indexed = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, lines = item
+            # coalesce whatever else is already waiting into the same write
+            batches = [item]
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batches.append(item)
+            try:
+                if log_file and (log_file.tell() >= self.max_bytes or timestamp - started >= self.max_age):
+                    log_file.close()
+                    idx_file.close()
+                    log_file = None
+                if not log_file:
+                    started = last_indexed = timestamp
+                    log_file, idx_file = self.open_segment(timestamp)
+                    idx_file.write('%f %d\n' % (timestamp, 0))
+                for timestamp, lines in batches:
+                    if timestamp - last_indexed >= self.index_interval:
+                        idx_file.write('%f %d\n' % (timestamp, log_file.tell()))
+                        last_indexed = timestamp
+                    log_file.write(''.join(line + '\n' for line in lines).encode('utf-8', 'replace'))
+                log_file.flush()
+                idx_file.flush()
+            except OSError as e:
+                print('Log store error: ' + str(e))
+                log_file = None
+        if log_file:
+            log_file.close()
+            idx_file.close()
+
+    def open_segment(self, timestamp):
+        name = '%s-%d' % (self.prefix, int(timestamp * 1000))
+        log_file = open(os.path.join(self.directory, name + '.log'), 'ab')
+        idx_file = open(os.path.join(self.directory, name + '.idx'), 'a')
+        self.prune()
+        return log_file, idx_file
+
+    def prune(self):
+        for name in self.segments()[:-self.max_segments]:
+            for ext in ('.log', '.idx'):
+                try:
+                    os.remove(os.path.join(self.directory, name + ext))
+                except OSError:
+                    pass
+            self.indexes.pop(name, None)
+
+    # reading, positions are (segment name, byte offset) tuples
+
+    def segments(self):
+        names = []
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith(self.prefix + '-') and file_name.endswith('.log'):
+                names.append(file_name[:-4])
+        return sorted(names, key=self.segment_start)
+
+    def segment_start(self, name):
+        return int(name.rsplit('-', 1)[1]) / 1000.0
+
+    def segment_path(self, name):
+        return os.path.join(self.directory, name + '.log')
+
+    def segment_size(self, name):
+        try:
+            return os.path.getsize(self.segment_path(name))
+        except OSError:
+            return 0
+
+    def get_index(self, name):
+        path = os.path.join(self.directory, name + '.idx')
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return [], []
+        cached = self.indexes.get(name)
+        if cached and cached[0] == size:
+            return cached[1], cached[2]
+        times, offsets = [], []
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    times.append(float(parts[0]))
+                    offsets.append(int(parts[1]))
+        self.indexes[name] = (size, times, offsets)
+        return times, offsets
+
+    def start(self):
+        segments = self.segments()
+        return (segments[0], 0) if segments else None
+
+    def end(self):
+        segments = self.segments()
+        return (segments[-1], self.segment_size(segments[-1])) if segments else None
+
+    def locate(self, timestamp):
+        segments = self.segments()
+        if not segments:
+            return None
+        starts = [self.segment_start(name) for name in segments]
+        i = bisect.bisect_right(starts, timestamp) - 1
+        if i < 0:
+            return segments[0], 0
+        name = segments[i]
+        times, offsets = self.get_index(name)
+        j = bisect.bisect_right(times, timestamp) - 1
+        return name, offsets[j] if j >= 0 else 0
+
+    def locate_ago(self, seconds):
+        return self.locate(time.time() - seconds)
+
+    def read_forward(self, position, count):
+        lines = []
+        segments = self.segments()
+        name, offset = position
+        while name in segments:
+            with open(self.segment_path(name), 'rb') as f:
+                f.seek(offset)
+                while len(lines) < count:
+                    line = f.readline()
+                    # stop at the end of the file or at a line the writer hasn't finished yet
+                    if not line.endswith(b'\n'):
+                        break
+                    lines.append(line[:-1].decode('utf-8', 'replace'))
+                    offset += len(line)
+            i = segments.index(name)
+            if len(lines) >= count or i + 1 == len(segments):
+                break
+            name, offset = segments[i + 1], 0
+        return lines, (name, offset)
+
+    def read_backward(self, position, count):
+        lines = []
+        segments = self.segments()
+        name, end = position
+        while name in segments:
+            page = self.page_size
+            with open(self.segment_path(name), 'rb') as f:
+                while len(lines) < count and end > 0:
+                    start = max(0, end - page)
+                    f.seek(start)
+                    buf = f.read(end - start)
+                    if start > 0:
+                        # the block starts in the middle of a line, skip up to the first line boundary
+                        cut = buf.find(b'\n', 0, len(buf) - 1)
+                        if cut < 0:
+                            page *= 2
+                            continue
+                        buf = buf[cut + 1:]
+                        start += cut + 1
+                    block = buf.split(b'\n')
+                    if block[-1] == b'':
+                        block.pop()
+                    taken = block[-(count - len(lines)):]
+                    lines = [line.decode('utf-8', 'replace') for line in taken] + lines
+                    if len(taken) < len(block):
+                        end -= sum(len(line) + 1 for line in taken)
+                    else:
+                        end = start
+            i = segments.index(name)
+            if len(lines) >= count or i == 0:
+                break
+            name = segments[i - 1]
+            end = self.segment_size(name)
+        return lines, (name, end)
+
+    def search(self, text, position, limit=1000, lines=5000):
+        """
+        One slice of a search running backward from `position`, at most `lines` lines read.
+
+        Returns the matches, newest first, and the position to carry on from, None once the start of
+        the store is reached.
+        """
+        chunk, next_position = self.read_backward(position, lines)
+        matches = [line for line in reversed(chunk) if text in line][:limit]
+        if len(chunk) < lines:
+            next_position = None
+        return matches, next_position
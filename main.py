@@ -1,34 +1,45 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-from PyQt5 import QtNetwork
 import getpass
 import os
 import signal
 import sys
-import zipfile
 import tempfile
 import json
 import time
-import shutil
 import urllib.request
-from io import BytesIO
+import codecs
+import hashlib
+import queue
+import random
+import re
+import threading
+from collections import deque
 
 from PyQt5.QtCore import QCoreApplication, QSettings, Qt, pyqtSignal, QSize, QUrl, QThread, QProcess, QObject, pyqtSlot, \
-    QSharedMemory, QIODevice
-from PyQt5.QtGui import QIcon, QTextCursor, QPixmap
-from PyQt5.QtNetwork import QLocalServer, QLocalSocket
-from PyQt5.QtPrintSupport import QPrinter, QPrintDialog, QPrintPreviewDialog
-from PyQt5.QtPrintSupport import QPrinterInfo
-from PyQt5.QtWebKit import QWebSettings
-from PyQt5.QtWebKitWidgets import QWebView, QWebPage, QWebInspector
+    QSharedMemory, QIODevice, QTimer, QPointF, QProcessEnvironment
+from PyQt5.QtGui import QIcon, QTextCursor, QPixmap, QTextCharFormat, QColor, QPainter, QPen, QIntValidator
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket, QTcpSocket, QNetworkAccessManager, QNetworkRequest
 from PyQt5.QtWidgets import QApplication, QWidget, QMessageBox, QDesktopWidget, QMainWindow, QAction, QVBoxLayout, \
-    QFileDialog, QSystemTrayIcon, QMenu, QTabWidget, QLabel, QTextEdit, QHBoxLayout, QPushButton, \
-    QLineEdit, QProgressBar, QShortcut, QDialog, QStyle, QWidgetItem, QSpacerItem
+    QFileDialog, QSystemTrayIcon, QMenu, QTabWidget, QLabel, QPlainTextEdit, QHBoxLayout, QPushButton, \
+    QLineEdit, QProgressBar, QShortcut, QDialog, QWidgetItem, QSpacerItem, QComboBox, QTableWidget, \
+    QTableWidgetItem, QAbstractItemView
 import pickle
 
-from utils import debug_trace, move_files, open_file, which, call_command, clean_pyc, free_port, \
+from backup import BackupAborted, OnlineBackup, RollbackPoints, StagedRestore, Throttle, fingerprint, migration_state
+from catalog import Catalog, snapshot_entry
+from download import Download
+from updater import DeltaUpdate
+from repository import Repository
+from schedule import Cron
+from logstore import LogStore
+from metrics import RequestMetrics
+from profiler import profiler
+from proxy import ReverseProxy, Backend
+from static import StaticFiles
+from utils import debug_trace, open_file, which, call_command, clean_pyc, free_port, \
     confirm_process_on_port, \
-    process_on_port, to_pycookiejar
+    process_on_port, rotate_file, kill_process_tree, find_free_port, format_size, lower_thread_priority
 
 BASE_PATH = os.path.dirname(os.path.realpath(sys.argv[0]))
 
@@ -47,23 +58,25 @@ class Tray(QSystemTrayIcon):
         menu = QMenu(self.cockpit)
         self.title = menu.addAction(QIcon(os.path.join(BASE_PATH, 'icons/awecode/16.png')),
                                     self.base.settings.get_title())
-        self.title.triggered.connect(self.base.browser.show_window)
+        self.title.triggered.connect(lambda: self.base.browser.show_window())
         menu.addSeparator()
         view_shell = menu.addAction(QIcon.fromTheme('text-x-script'), 'Service')
-        view_shell.triggered.connect(lambda: self.show_tab(0))
+        view_shell.triggered.connect(lambda: self.show_tab(self.cockpit.service_tab))
         settings = menu.addAction(QIcon.fromTheme('emblem-system'), 'Set&tings')
-        settings.triggered.connect(lambda: self.show_tab(1))
+        settings.triggered.connect(lambda: self.show_tab(self.cockpit.setting_tab))
         backup_restore = menu.addAction(QIcon.fromTheme('media-seek-backward'), '&Backup/Restore')
-        backup_restore.triggered.connect(lambda: self.show_tab(2))
+        backup_restore.triggered.connect(lambda: self.show_tab(self.cockpit.backup_tab))
         if self.base.settings.get_remote_url():
             check_update = menu.addAction(QIcon.fromTheme('system-software-update'), 'Check for &Updates')
-            check_update.triggered.connect(lambda: self.show_tab(3))
+            check_update.triggered.connect(lambda: self.show_tab(self.cockpit.updates_tab))
         tools = menu.addAction(QIcon.fromTheme('emblem-system'), 'Tools')
-        tools.triggered.connect(lambda: self.show_tab(4))
+        tools.triggered.connect(lambda: self.show_tab(self.cockpit.tools_tab))
         console = menu.addAction(QIcon.fromTheme('emblem-system'), 'Console')
-        console.triggered.connect(lambda: self.show_tab(5))
+        console.triggered.connect(lambda: self.show_tab(self.cockpit.console_tab))
+        metrics = menu.addAction(QIcon.fromTheme('utilities-system-monitor'), '&Metrics')
+        metrics.triggered.connect(lambda: self.show_tab(self.cockpit.metrics_tab))
         about = menu.addAction(QIcon.fromTheme('help-about'), '&About')
-        about.triggered.connect(lambda: self.show_tab(6))
+        about.triggered.connect(lambda: self.show_tab(self.cockpit.about_tab))
         menu.addSeparator()
         exit_action = menu.addAction(QIcon.fromTheme('exit'), 'E&xit')
         exit_action.triggered.connect(self.cockpit.quit)
@@ -78,12 +91,15 @@ class Tray(QSystemTrayIcon):
     def open_settings_file(self):
         open_file('settings.ini')
 
-    def show_tab(self, tab_index):
-        self.base.cockpit.tabs.setCurrentIndex(tab_index)
+    def show_tab(self, tab):
+        if isinstance(tab, int):
+            tab = self.base.cockpit.tabs.widget(tab)
+        tab.build()
+        self.base.cockpit.tabs.setCurrentWidget(tab)
         self.base.cockpit.show_window()
 
     def service_status(self, st):
-        if st == 'Started':
+        if st == 'Ready':
             self.title.setEnabled(True)
         else:
             self.title.setEnabled(False)
@@ -91,6 +107,9 @@ class Tray(QSystemTrayIcon):
 
 class Settings(QSettings):
     exists = True
+    cron_expression = ''
+    cron = None
+    backends = ('runserver', 'gunicorn', 'waitress', 'uvicorn')
 
     def __init__(self, base):
         self.base = base
@@ -105,6 +124,7 @@ class Settings(QSettings):
             self.get_python_path())
 
     def warn(self):
+        self.base.cockpit.setting_tab.build()
         if not self.get_project_path():
             QMessageBox.critical(None, 'Settings', 'Please fix project path and start service.', QMessageBox.Ok)
             self.base.cockpit.setting_tab.project_path_edit.setFocus(True)
@@ -156,6 +176,16 @@ class Settings(QSettings):
             return int(self.value('port'))
         return 8888
 
+    def get_log_max_lines(self):
+        if self.value('log_max_lines'):
+            return int(self.value('log_max_lines'))
+        return 5000
+
+    def get_log_dir(self):
+        if self.value('log_dir'):
+            return self.value('log_dir')
+        return os.path.join(BASE_PATH, 'logs')
+
     def get_db_file(self):
         if self.value('db_file'):
             return self.value('db_file')
@@ -170,8 +200,8 @@ class Settings(QSettings):
     def get_url(self):
         return 'http://' + self.get_addr()
 
-    def get_local_url(self):
-        return 'http://127.0.0.1:' + str(self.get_port())
+    def get_local_url(self, port=None):
+        return 'http://127.0.0.1:' + str(port or self.get_port())
 
     def get_backup_dir(self):
         self.beginGroup('History')
@@ -179,6 +209,54 @@ class Settings(QSettings):
         self.endGroup()
         return backup_dir
 
+    def get_backup_repository(self):
+        if self.get_backup_dir():
+            return Repository(os.path.join(self.get_backup_dir(), 'cockpit-backups'))
+
+    def get_backup_catalog(self):
+        if self.get_backup_dir():
+            return Catalog(os.path.join(self.get_backup_dir(), 'cockpit-backups', 'catalog.sqlite3'))
+
+    def get_backup_retention(self):
+        return dict((key, int(self.value('backup_' + key) or default))
+                    for key, default in (('keep_last', 10), ('keep_daily', 7), ('keep_weekly', 4)))
+
+    def get_rollback_points(self):
+        if self.get_project_path() and os.path.isfile(self.get_db_file_path()):
+            return RollbackPoints(self.get_db_file_path(), keep=int(self.value('rollback_keep') or 5))
+
+    def get_backup_interval(self):
+        # minutes, 0 turns interval backups off
+        return int(self.value('backup_interval') or 0)
+
+    def get_backup_cron(self):
+        # parsed once per expression, so a bad one is reported once rather than on every check
+        expression = self.value('backup_cron') or ''
+        if expression != self.cron_expression:
+            self.cron_expression = expression
+            self.cron = None
+            if expression:
+                try:
+                    self.cron = Cron(expression)
+                except ValueError as e:
+                    print('Ignoring backup_cron: ' + str(e))
+        return self.cron
+
+    def get_backup_rate(self):
+        # bytes per second scheduled backups may read, manual backups aren't throttled
+        return int(self.value('backup_rate') or 10 * 1024 * 1024)
+
+    def get_backup_stats(self):
+        self.beginGroup('History')
+        stats = self.get('backup_stats', {})
+        self.endGroup()
+        return stats
+
+    def set_backup_stats(self, stats):
+        self.beginGroup('History')
+        self.setValue('backup_stats', json.dumps(stats))
+        self.endGroup()
+
     def get_backup_file_path(self):
         self.beginGroup('History')
         backup_file_val = self.value('backup_file')
@@ -225,8 +303,116 @@ class Settings(QSettings):
         url += '/archive/master.zip'
         return url
 
-    def get_cmdline(self):
-        cmdline = [self.get_python_path(), '-i', 'manage.py', 'runserver', '--noreload', self.get_addr()]
+    def get_download_path(self):
+        # stable per url, so an interrupted download is picked up again by the next try
+        name = 'cockpit-update-%s.zip' % hashlib.sha1(self.get_download_url().encode('utf-8')).hexdigest()[:12]
+        return os.path.join(tempfile.gettempdir(), name)
+
+    def get_checksum_url(self):
+        # a text file starting with the sha256 of the archive, updates aren't checked without one
+        return self.value('update_checksum_url') or ''
+
+    def get_health_url(self, port=None):
+        path = self.value('health_path') or '/'
+        return self.get_local_url(port) + '/' + path.lstrip('/')
+
+    def get_startup_history(self):
+        self.beginGroup('History')
+        history = self.get('startup_history', [])
+        self.endGroup()
+        return history
+
+    def add_startup_time(self, timing, keep=50):
+        history = self.get_startup_history()[-(keep - 1):] + [timing]
+        self.beginGroup('History')
+        self.setValue('startup_history', json.dumps(history))
+        self.endGroup()
+
+    def get_backend(self):
+        backend = self.value('backend')
+        if backend in self.backends:
+            return backend
+        return 'runserver'
+
+    def get_int(self, key, default):
+        # saved from free text, a value that doesn't parse mustn't keep the service or the settings from loading
+        try:
+            return int(self.value(key))
+        except (TypeError, ValueError):
+            return default
+
+    def get_workers(self):
+        return self.get_int('workers', os.cpu_count() or 1)
+
+    def get_threads(self):
+        return self.get_int('threads', 4 if self.get_backend() == 'waitress' else 1)
+
+    def get_auto_restart(self):
+        return str(self.value('auto_restart') or 'true').lower() not in ('false', '0', 'no')
+
+    def get_standby(self):
+        return str(self.value('standby') or 'false').lower() in ('true', '1', 'yes')
+
+    def supports_standby(self):
+        # the standby serves the loaded application itself, which only maps onto the single process servers
+        return self.get_backend() in ('runserver', 'waitress')
+
+    def get_settings_module(self):
+        if self.value('settings_module'):
+            return self.value('settings_module')
+        manage_py = os.path.join(self.get_project_path(), 'manage.py')
+        if os.path.isfile(manage_py):
+            with open(manage_py) as f:
+                match = re.search(r'DJANGO_SETTINGS_MODULE[\'"]\s*,\s*[\'"]([\w.]+)[\'"]', f.read())
+            if match:
+                return match.group(1)
+        return ''
+
+    def get_proxy_backends(self):
+        return self.get_int('proxy_backends', 0)
+
+    def get_static_mappings(self):
+        # STATIC_ROOT/MEDIA_ROOT of the project, served by the cockpit's proxy when set
+        mappings = []
+        for kind in ('static', 'media'):
+            root = self.value(kind + '_root')
+            if root:
+                root = os.path.join(self.get_project_path(), root)
+                if os.path.isdir(root):
+                    url = self.value(kind + '_url') or '/' + kind + '/'
+                    mappings.append(('/' + url.strip('/') + '/', root))
+        return mappings
+
+    def get_application(self, kind='wsgi'):
+        # e.g. wsgi_application = project.wsgi:application, guessed from the folder holding wsgi.py/asgi.py
+        if self.value(kind + '_application'):
+            return self.value(kind + '_application')
+        project_path = self.get_project_path()
+        if os.path.isdir(project_path):
+            for name in sorted(os.listdir(project_path)):
+                if os.path.isfile(os.path.join(project_path, name, kind + '.py')):
+                    return name + '.' + kind + ':application'
+        return ''
+
+    def get_cmdline(self, host=None, port=None):
+        host = host or self.get_host()
+        port = port or self.get_port()
+        addr = host + ':' + str(port)
+        python = self.get_python_path()
+        backend = self.get_backend()
+        if backend == 'gunicorn':
+            cmdline = [python, '-m', 'gunicorn', '--bind', addr, '--workers', str(self.get_workers()),
+                       '--threads', str(self.get_threads()), '--access-logfile', '-',
+                       '--access-logformat', '%(t)s "%(r)s" %(s)s %(b)s %(L)s', self.get_application('wsgi')]
+        elif backend == 'waitress':
+            # waitress is a single process, it only scales with threads
+            cmdline = [python, '-m', 'waitress', '--listen=' + addr, '--threads=' + str(self.get_threads()),
+                       self.get_application('wsgi')]
+        elif backend == 'uvicorn':
+            cmdline = [python, '-m', 'uvicorn', '--host', host, '--port', str(port), '--workers',
+                       str(self.get_workers()), self.get_application('asgi')]
+        else:
+            cmdline = [python, '-i', 'manage.py', 'runserver', '--noreload', addr]
         return cmdline
 
     def set_cookies(self, data):
@@ -245,6 +431,10 @@ class Settings(QSettings):
 
 
 class Tab(QWidget):
+    # content is built the first time the tab is shown, tabs other code writes into from the start opt out
+    lazy = True
+    built = False
+
     def __init__(self, *args, **kwargs):
         self.tab_widget = kwargs.pop('tab_widget')
         self.settings = self.tab_widget.settings
@@ -257,10 +447,23 @@ class Tab(QWidget):
         self.layout.setAlignment(Qt.AlignTop | Qt.AlignLeft)
         self.setLayout(self.layout)
         self.tab_widget.currentChanged.connect(self.tab_changed)
-        self.add_content()
+        if not self.lazy:
+            self.build()
+
+    def build(self):
+        if not self.built:
+            self.built = True
+            with profiler.span('tab.' + self.__class__.__name__):
+                self.add_content()
+
+    def showEvent(self, event):
+        # the page is shown before the tab widget reports the change
+        self.build()
+        super(Tab, self).showEvent(event)
 
     def tab_changed(self, i):
         if self.tab_widget.indexOf(self) == i:
+            self.build()
             self.on_active()
 
     def on_active(self):
@@ -291,49 +494,135 @@ class Tab(QWidget):
         self.add(label)
 
 
-class Log(QTextEdit):
-    def __init__(self):
+class Log(QPlainTextEdit):
+    max_lines = 5000
+    colors = {'warning': 'yellow', 'error': 'red'}
+
+    def __init__(self, max_lines=None):
         super(Log, self).__init__()
         self.setReadOnly(True)
-        self.setLineWrapMode(QTextEdit.NoWrap)
+        self.setLineWrapMode(QPlainTextEdit.NoWrap)
         self.setStyleSheet("color: white; background: black")
         font = self.font()
         font.setFamily("Courier")
         font.setPointSize(10)
-        self.html = ''
-
-    def add_line(self, st):
-        self.moveCursor(QTextCursor.End)
-        self.html += '<pre>' + st + '</pre>'
-        self.setHtml(self.html)
+        self.setFont(font)
+        # the document drops its oldest blocks once it grows past this, so it works as a ring buffer of lines
+        self.setMaximumBlockCount(max_lines or self.max_lines)
+        self.formats = {}
+
+    def get_format(self, kind=None):
+        if kind not in self.formats:
+            fmt = QTextCharFormat()
+            if kind in self.colors:
+                fmt.setForeground(QColor(self.colors[kind]))
+            self.formats[kind] = fmt
+        return self.formats[kind]
+
+    def add_line(self, st, kind=None):
+        self.add_lines([st.rstrip('\r\n')], kind)
+
+    def add_lines(self, lines, kind=None):
+        if not lines:
+            return
+        # only the tail can survive the block limit, skip laying out lines that would be evicted right away
+        lines = lines[-self.maximumBlockCount():]
         sb = self.verticalScrollBar()
-        sb.setValue(sb.maximum())
-        self.updateGeometry()
+        at_bottom = sb.value() == sb.maximum()
+        cursor = QTextCursor(self.document())
+        cursor.beginEditBlock()
+        cursor.movePosition(QTextCursor.End)
+        if not self.document().isEmpty():
+            cursor.insertBlock()
+        cursor.insertText('\n'.join(lines), self.get_format(kind))
+        cursor.endEditBlock()
+        if at_bottom:
+            sb.setValue(sb.maximum())
 
     def add_warning(self, st):
-        self.add_line('<span style="color:yellow">' + st + '</span>')
+        self.add_line(st, 'warning')
 
     def add_error(self, st):
-        self.add_line('<span style="color:red">' + st + '</span>')
+        self.add_line(st, 'error')
+
+
+class OutputReader(QObject):
+    lines_ready = pyqtSignal(list)
+    dropped = pyqtSignal(int)
+    interval = 75
+    max_pending = 20000
+
+    def __init__(self, device, interval=None, max_pending=None):
+        super(OutputReader, self).__init__(device)
+        self.device = device
+        self.max_pending = max_pending or self.max_pending
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.partial = ''
+        self.pending = deque()
+        self.dropped_count = 0
+        self.received = False
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval or self.interval)
+        self.timer.timeout.connect(self.flush)
+        device.readyRead.connect(self.read)
+
+    def read(self):
+        self.feed(bytes(self.device.readAll()))
+
+    def feed(self, data):
+        text = self.partial + self.decoder.decode(data)
+        lines = text.split('\n')
+        self.partial = lines.pop()
+        self.pending.extend(line.rstrip('\r') for line in lines)
+        overflow = len(self.pending) - self.max_pending
+        if overflow > 0:
+            # the view is behind, throw away the oldest lines instead of growing without bound
+            for _ in range(overflow):
+                self.pending.popleft()
+            self.dropped_count += overflow
+        self.received = True
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def flush(self, final=False):
+        if final:
+            self.partial += self.decoder.decode(b'', True)
+            self.decoder.reset()
+        if self.partial and (final or not self.received):
+            # nothing arrived for a whole tick, so this is a prompt rather than the start of a line
+            self.pending.append(self.partial.rstrip('\r'))
+            self.partial = ''
+        self.received = False
+        if self.dropped_count:
+            self.dropped.emit(self.dropped_count)
+            self.dropped_count = 0
+        if self.pending:
+            lines = list(self.pending)
+            self.pending.clear()
+            self.lines_ready.emit(lines)
+        elif not self.partial:
+            self.timer.stop()
+
+    def finish(self):
+        self.read()
+        self.flush(True)
 
 
 class Worker(QObject):
     response = pyqtSignal(str)
-    download_response = pyqtSignal(bytes)
+    download_response = pyqtSignal(str)
+    download_progress = pyqtSignal(int, int)
     error = pyqtSignal(str)
 
     def __init__(self, settings):
         super().__init__()
         self.settings = settings
 
-    def watch_port(self):
-
-        while True:
-            if confirm_process_on_port(self.settings.get_port(), self.settings.get_cmdline()):
-                self.response.emit('Started')
-            else:
-                self.response.emit('Stopped')
-            time.sleep(2)
+    def check_port(self):
+        if confirm_process_on_port(self.settings.get_port(), self.settings.get_cmdline()):
+            self.response.emit('Started')
+        else:
+            self.response.emit('Stopped')
 
     def get_version(self):
         try:
@@ -343,27 +632,557 @@ class Worker(QObject):
             self.response.emit(str(e))
 
     def download_update(self):
-        download_url = self.settings.get_download_url()
         try:
-            with urllib.request.urlopen(download_url) as response:
-                zip_content = response.read()
-                self.download_response.emit(zip_content)
+            checksum = None
+            if self.settings.get_checksum_url():
+                with urllib.request.urlopen(self.settings.get_checksum_url()) as response:
+                    checksum = response.read().decode('utf-8').split()[0]
+            self.download = Download(self.settings.get_download_url(), self.settings.get_download_path(),
+                                     sha256=checksum, progress=self.download_progress.emit)
+            self.download_response.emit(self.download.run())
         except Exception as e:
             self.error.emit('Error: ' + str(e))
 
 
+class BackupWorker(QObject):
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(str)
+    error = pyqtSignal(str)
+
+    def __init__(self, source, repository, retention, rate=None, catalog=None):
+        super().__init__()
+        self.source = source
+        self.repository = repository
+        self.retention = retention
+        self.catalog = catalog
+        self.throttle = Throttle(rate) if rate else None
+        self.snapshot_file = os.path.join(repository.root, 'tmp', os.path.basename(source))
+        self.backup = OnlineBackup(source, self.snapshot_file, progress=self.progress.emit, throttle=self.throttle)
+        self.cancelled = False
+
+    def cancel(self):
+        # called from the GUI thread, both phases check the flag between steps
+        self.cancelled = True
+        self.backup.cancel()
+
+    def store_step(self, done, total):
+        if self.cancelled:
+            raise BackupAborted('Backup cancelled.')
+        self.progress.emit(done, total)
+
+    def run(self):
+        try:
+            if self.throttle:
+                lower_thread_priority()
+            os.makedirs(os.path.dirname(self.snapshot_file), exist_ok=True)
+            self.backup.run()
+            try:
+                snapshot = self.repository.store(self.snapshot_file, self.source, self.store_step,
+                                                 extra={'migration': migration_state(self.snapshot_file)},
+                                                 throttle=self.throttle)
+            finally:
+                os.remove(self.snapshot_file)
+            removed = self.repository.prune(**self.retention)
+            if self.catalog:
+                self.catalog.add(snapshot_entry(snapshot))
+                self.catalog.remove(['snapshot:' + old.id for old in removed])
+            stats = snapshot.manifest['stats']
+            self.done.emit('%d of %d chunks changed, %s written%s.' % (
+                stats['new_chunks'], stats['chunks'], format_size(stats['written']),
+                ', %d old snapshots pruned' % len(removed) if removed else ''))
+        except Exception as e:
+            self.error.emit(str(e))
+
+
+class CatalogWorker(QObject):
+    done = pyqtSignal(int, float)
+    error = pyqtSignal(str)
+
+    def __init__(self, catalog, repository, directory):
+        super().__init__()
+        self.catalog = catalog
+        self.repository = repository
+        self.directory = directory
+
+    def run(self):
+        try:
+            self.done.emit(*self.catalog.rebuild(self.repository, self.directory))
+        except Exception as e:
+            self.error.emit(str(e))
+
+
+class RestoreWorker(QObject):
+    progress = pyqtSignal(int, int)
+    ready = pyqtSignal()
+    error = pyqtSignal(str)
+
+    def __init__(self, target, source=None, repository=None, snapshot=None):
+        super().__init__()
+        self.source = source
+        self.repository = repository
+        self.snapshot = snapshot
+        self.restore = StagedRestore(target, progress=self.progress.emit)
+
+    def run(self):
+        try:
+            if self.snapshot:
+                self.restore.stage_snapshot(self.repository, self.snapshot)
+            else:
+                self.restore.stage_file(self.source)
+            self.ready.emit()
+        except Exception as e:
+            self.error.emit(str(e))
+
+
+class RollbackWorker(QObject):
+    done = pyqtSignal(dict)
+    error = pyqtSignal(str)
+
+    def __init__(self, points, reason):
+        super().__init__()
+        self.points = points
+        self.reason = reason
+
+    def run(self):
+        try:
+            self.done.emit(self.points.take(self.reason))
+        except Exception as e:
+            self.error.emit(str(e))
+
+
+class BackupScheduler(QObject):
+    """
+    Runs one backup at a time, manual ones and those due on the backup_interval/backup_cron schedule.
+
+    Scheduled runs are throttled and run at idle priority, and are skipped while the database files
+    haven't changed since the last backup.
+    """
+    check_interval = 30 * 1000
+    started = pyqtSignal(str)
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(str)
+    error = pyqtSignal(str)
+    stats_changed = pyqtSignal()
+
+    def __init__(self, settings):
+        super(BackupScheduler, self).__init__(app)
+        self.settings = settings
+        self.thread = None
+        self.last_checked = time.time()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.check)
+        self.timer.start(self.check_interval)
+        app.aboutToQuit.connect(self.cancel)
+
+    def is_running(self):
+        return self.thread is not None
+
+    def is_due(self, now, stats):
+        interval = self.settings.get_backup_interval()
+        if interval and now - stats.get('last_run', 0) >= interval * 60:
+            return True
+        cron = self.settings.get_backup_cron()
+        # any minute since the last check counts, so a run isn't lost to a busy loop or a suspend
+        return bool(cron) and cron.due_between(self.last_checked, now)
+
+    def check(self):
+        now = time.time()
+        stats = self.settings.get_backup_stats()
+        due = self.is_due(now, stats)
+        self.last_checked = now
+        if not due or self.is_running() or not self.settings.get_backup_repository():
+            return
+        source = self.settings.get_db_file_path()
+        if not os.path.isfile(source):
+            return
+        if stats.get('source') == source and stats.get('fingerprint') == json.loads(json.dumps(fingerprint(source))):
+            stats.update(last_run=now, last_result='Unchanged', skipped=stats.get('skipped', 0) + 1)
+            self.settings.set_backup_stats(stats)
+            self.stats_changed.emit()
+            return
+        self.run(source, scheduled=True)
+
+    def run(self, source, scheduled=False):
+        if self.is_running():
+            return False
+        self.source = source
+        self.scheduled = scheduled
+        self.source_fingerprint = fingerprint(source)
+        self.span = profiler.span('backup', file=source, scheduled=scheduled)
+        self.thread = QThread(app)
+        self.worker = BackupWorker(source, self.settings.get_backup_repository(), self.settings.get_backup_retention(),
+                                   self.settings.get_backup_rate() if scheduled else None,
+                                   self.settings.get_backup_catalog())
+        self.worker.progress.connect(self.progress)
+        self.worker.done.connect(self.on_done)
+        self.worker.error.connect(self.on_error)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.thread.start()
+        self.started.emit(source)
+        return True
+
+    def cancel(self):
+        if self.thread:
+            self.worker.cancel()
+            self.thread.quit()
+            self.thread.wait()
+
+    def on_done(self, summary):
+        self.finish('Done')
+        self.done.emit(summary)
+
+    def on_error(self, st):
+        self.finish('Failed', st)
+        self.error.emit(st)
+
+    def finish(self, result, error=None):
+        self.thread.quit()
+        self.thread.wait()
+        self.thread = None
+        duration = self.span.end(status=result)
+        stats = self.settings.get_backup_stats()
+        stats.update(last_run=time.time(), last_result=error or result, last_duration=duration,
+                     scheduled=self.scheduled, runs=stats.get('runs', 0) + 1)
+        if error:
+            stats['failures'] = stats.get('failures', 0) + 1
+        else:
+            stats.update(source=self.source, fingerprint=self.source_fingerprint)
+        self.settings.set_backup_stats(stats)
+        self.stats_changed.emit()
+
+
+class Liveness(QObject):
+    status_changed = pyqtSignal(str)
+    check_requested = pyqtSignal()
+    starting_interval = 250
+    running_interval = 5000
+    fallback_interval = 60000
+
+    def __init__(self, process, settings, port=None, fallback=True):
+        super(Liveness, self).__init__(process)
+        self.process = process
+        self.settings = settings
+        self.port = port
+        self.status = None
+        self.enabled = True
+        self.socket = QTcpSocket(self)
+        self.socket.connected.connect(self.probe_succeeded)
+        self.socket.error.connect(self.probe_failed)
+        self.probe_timer = QTimer(self)
+        self.probe_timer.timeout.connect(self.probe)
+        process.stateChanged.connect(self.state_changed)
+
+        # a server we didn't spawn (e.g. left over from a previous run) can only be found by a full process scan,
+        # so that is done rarely and off the GUI thread while our own process is not running
+        self.fallback_timer = QTimer(self)
+        self.fallback_timer.setInterval(self.fallback_interval)
+        if fallback:
+            self.thread = QThread(self)
+            self.worker = Worker(settings)
+            self.worker.moveToThread(self.thread)
+            self.worker.response[str].connect(self.fallback_response)
+            self.check_requested.connect(self.worker.check_port)
+            self.thread.start()
+            app.aboutToQuit.connect(self.thread.quit)
+            self.fallback_timer.timeout.connect(self.check_requested)
+            self.fallback_timer.start()
+            self.check_requested.emit()
+
+    def set_status(self, st):
+        # edge-triggered, listeners only hear about actual changes
+        if st != self.status:
+            self.status = st
+            self.status_changed.emit(st)
+
+    def is_running(self):
+        return self.process.state() != QProcess.NotRunning
+
+    def state_changed(self, state):
+        if state == QProcess.NotRunning:
+            self.probe_timer.stop()
+            self.socket.abort()
+            if hasattr(self, 'worker'):
+                self.fallback_timer.start()
+            self.set_status('Stopped')
+        elif state == QProcess.Running and self.enabled:
+            self.watch()
+
+    def watch(self):
+        self.enabled = True
+        self.fallback_timer.stop()
+        self.probe_timer.start(self.starting_interval)
+        self.probe()
+
+    def probe(self):
+        self.socket.abort()
+        self.socket.connectToHost('127.0.0.1', self.port or self.settings.get_port())
+
+    def probe_succeeded(self):
+        self.socket.abort()
+        if self.is_running():
+            self.probe_timer.setInterval(self.running_interval)
+            self.set_status('Started')
+
+    def probe_failed(self):
+        self.socket.abort()
+        if self.is_running():
+            self.probe_timer.setInterval(self.starting_interval)
+            self.set_status('Stopped')
+
+    def fallback_response(self, st):
+        if not self.is_running():
+            self.set_status(st)
+
+    def close(self):
+        self.fallback_timer.stop()
+        if hasattr(self, 'worker'):
+            self.thread.quit()
+            self.thread.wait()
+
+
+class Readiness(QObject):
+    ready = pyqtSignal()
+    first_delay = 100
+    max_delay = 2000
+    timeout = 5 * 60
+
+    def __init__(self, settings, port=None, parent=None):
+        super(Readiness, self).__init__(parent)
+        self.settings = settings
+        self.port = port
+        self.manager = QNetworkAccessManager(self)
+        self.manager.finished.connect(self.on_reply)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.poll)
+        self.reply = None
+        self.started = self.bound_at = self.polling_since = None
+        self.timing = None
+
+    def begin(self):
+        self.cancel()
+        self.started = time.monotonic()
+        self.bound_at = None
+
+    def bound(self):
+        self.cancel()
+        self.bound_at = time.monotonic()
+        self.polling_since = self.bound_at
+        self.delay = self.first_delay
+        self.poll()
+
+    def cancel(self):
+        self.timer.stop()
+        reply, self.reply = self.reply, None
+        if reply:
+            reply.abort()
+
+    def poll(self):
+        self.reply = self.manager.get(QNetworkRequest(QUrl(self.settings.get_health_url(self.port))))
+
+    def on_reply(self, reply):
+        reply.deleteLater()
+        if reply is not self.reply:
+            return
+        self.reply = None
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        # any answer from the application counts, a 404 on the health url still means Django is serving
+        if status and status < 500:
+            now = time.monotonic()
+            self.timing = None
+            if self.started and self.bound_at:
+                self.timing = {'started': time.time(), 'bind': self.bound_at - self.started, 'ready': now - self.started}
+            self.started = None
+            self.ready.emit()
+        elif time.monotonic() - self.polling_since < self.timeout:
+            self.timer.start(self.delay)
+            self.delay = min(self.delay * 2, self.max_delay)
+
+
+STANDBY_READY = 'Cockpit standby ready'
+STANDBY_STALE_EXIT = 3
+
+
+class ServerProcess(QObject):
+    status_changed = pyqtSignal(str)
+    lines_ready = pyqtSignal(list)
+    dropped = pyqtSignal(int)
+    exited = pyqtSignal(int, str)
+
+    def __init__(self, settings, host=None, port=None, standby=False):
+        super(ServerProcess, self).__init__(app)
+        self.settings = settings
+        self.host = host
+        self.port = port
+        self.status = 'Stopped'
+        self.stopping = False
+        self.started_at = None
+        self.parked = False
+        self.warm = False
+        self.output_connected = False
+        self.backend = Backend('127.0.0.1', port) if port else None
+        self.process = QProcess(self)
+        self.process.setReadChannel(QProcess.StandardOutput)
+        self.process.setProcessChannelMode(QProcess.MergedChannels)
+        self.reader = OutputReader(self.process)
+        self.reader.lines_ready.connect(self.lines_ready)
+        self.reader.dropped.connect(self.dropped)
+        self.process.error.connect(self.on_error)
+        self.process.finished.connect(self.on_finish)
+        self.reader.lines_ready.connect(self.check_standby)
+        # only a server on the public port can be one we didn't start ourselves
+        self.liveness = Liveness(self.process, settings, port, fallback=port is None and not standby)
+        self.liveness.status_changed.connect(self.port_response)
+        self.readiness = Readiness(settings, port, self)
+        self.readiness.ready.connect(self.on_ready)
+
+    def set_status(self, st):
+        if st != self.status:
+            self.status = st
+            self.status_changed.emit(st)
+
+    def start(self):
+        self.stopping = False
+        self.started_at = time.monotonic()
+        self.readiness.begin()
+        if self.parked and self.process.state() == QProcess.Running:
+            return self.promote()
+        self.parked = False
+        self.liveness.enabled = True
+        if self.settings.value('project_path'):
+            self.process.setWorkingDirectory(self.settings.value('project_path'))
+        cmdline = self.settings.get_cmdline(self.host, self.port)
+        self.process.start(cmdline[0], cmdline[1:])
+
+    def park(self):
+        # start a standby interpreter that imports the project but doesn't bind until promoted
+        self.parked = True
+        self.liveness.enabled = False
+        self.process.setWorkingDirectory(self.settings.get_project_path())
+        environment = QProcessEnvironment.systemEnvironment()
+        if self.settings.get_settings_module():
+            environment.insert('DJANGO_SETTINGS_MODULE', self.settings.get_settings_module())
+        self.process.setProcessEnvironment(environment)
+        self.process.start(self.settings.get_python_path(),
+                           [os.path.join(BASE_PATH, 'standby.py'), self.settings.get_backend(),
+                            str(self.settings.get_threads())])
+
+    def promote(self):
+        host = self.host or self.settings.get_host()
+        port = self.port or self.settings.get_port()
+        self.process.write((host + ':' + str(port) + '\n').encode('utf-8'))
+        self.liveness.watch()
+
+    def check_standby(self, lines):
+        if self.parked and not self.warm and STANDBY_READY in lines:
+            self.warm = True
+
+    def uptime(self):
+        return time.monotonic() - self.started_at if self.started_at else 0
+
+    def kill(self):
+        self.stopping = True
+        self.readiness.cancel()
+        # gunicorn/uvicorn fork workers, take the whole group down with the master
+        if self.process.processId():
+            kill_process_tree(self.process.processId())
+        self.process.kill()
+        # let the port go before anything else tries to bind it
+        self.process.waitForFinished(1000)
+        self.set_status('Stopped')
+
+    def close(self):
+        self.kill()
+        self.liveness.close()
+        self.deleteLater()
+
+    @pyqtSlot(str)
+    def port_response(self, str):
+        if str == 'Started':
+            self.readiness.bound()
+        else:
+            self.readiness.cancel()
+        self.set_status(str)
+
+    def on_ready(self):
+        self.parked = False
+        self.set_status('Ready')
+
+    def on_finish(self, exit_code=0, exit_status=None):
+        self.reader.finish()
+        self.set_status('Stopped')
+        if not self.stopping:
+            self.exited.emit(exit_code, str(self.process.readAllStandardError(), encoding='utf-8'))
+        self.started_at = None
+
+    def on_error(self, error):
+        # a crash is followed by finished(), only a failed start has to be reported here
+        if error == QProcess.FailedToStart:
+            self.set_status('Stopped')
+            if not self.stopping:
+                self.exited.emit(-1, 'Error occurred while trying to run service. ' + self.process.errorString())
+            self.started_at = None
+
+
+class Supervisor(object):
+    base_delay = 1.0
+    max_delay = 60.0
+    budget = 5
+    budget_window = 5 * 60
+    min_uptime = 10
+    max_flaps = 3
+
+    def __init__(self):
+        self.restarts = 0
+        self.exits = deque(maxlen=20)
+        self.reset()
+
+    def reset(self):
+        self.recent = deque()
+        self.failures = 0
+        self.flaps = 0
+        self.reason = None
+
+    def on_exit(self, code, uptime):
+        """Record an unexpected exit, returns the delay before restarting or None to give up."""
+        now = time.monotonic()
+        self.exits.append((time.time(), code, uptime))
+        if uptime < self.min_uptime:
+            self.flaps += 1
+        else:
+            # it ran fine for a while, start backing off from scratch
+            self.flaps = 0
+            self.failures = 0
+        while self.recent and now - self.recent[0] > self.budget_window:
+            self.recent.popleft()
+        if self.flaps >= self.max_flaps:
+            self.reason = 'it exited within %ds of starting %d times in a row' % (self.min_uptime, self.flaps)
+            return None
+        if len(self.recent) >= self.budget:
+            self.reason = 'it was restarted %d times in the last %d minutes' % (len(self.recent), self.budget_window // 60)
+            return None
+        self.recent.append(now)
+        self.restarts += 1
+        delay = min(self.max_delay, self.base_delay * 2 ** self.failures)
+        self.failures += 1
+        # jitter so several crashing workers don't come back in lockstep
+        return delay * random.uniform(0.5, 1.0)
+
+
 class ServiceTab(Tab):
-    manual_stop = False
+    lazy = False
     service_status = pyqtSignal(str)
+    drain_timeout = 30
 
     def set_process_status(self, st):
         self.process_status = st
         self.status_text.setText(st)
 
-        if self.process_status == 'Started':
+        if self.process_status in ('Started', 'Ready'):
             self.start_button.setEnabled(False)
             self.stop_button.setEnabled(True)
-            if self.base.browser_waiting:
+            if self.process_status == 'Ready' and self.base.browser_waiting:
                 self.base.browser.show_window()
                 self.base.browser_waiting = False
         else:
@@ -371,41 +1190,223 @@ class ServiceTab(Tab):
             self.stop_button.setEnabled(False)
         self.service_status.emit(str(st))
 
-    # def restart_process(self):
-    #     self.stop_process()
-    #     self.start_process()
+    def restart_process(self):
+        # without the proxy (or nothing serving yet) there is no way around a cold restart
+        if not self.proxy.is_running() or not any(s.status == 'Ready' for s in self.servers) or self.retiring:
+            return self.start_process()
+        self.console.add_warning('Starting new servers, the current ones keep serving until they are ready.')
+        self.finish_span('Superseded')
+        self.start_span = profiler.span('service.restart', backend=self.settings.get_backend())
+        self.close_servers(self.draining)
+        self.retiring, self.servers = self.servers, []
+        self.timing_recorded = False
+        for server in self.create_servers():
+            self.add_server(server)
+            server.start()
+
+    def create_servers(self):
+        count = self.settings.get_proxy_backends()
+        servers = [self.take_standby()] if self.standby else []
+        servers = [server for server in servers if server]
+        if not count:
+            return servers or [ServerProcess(self.settings)]
+        return servers + [ServerProcess(self.settings, '127.0.0.1', find_free_port()) for i in range(count - len(servers))]
+
+    def standby_signature(self):
+        return (self.settings.get_python_path(), self.settings.get_project_path(), self.settings.get_backend(),
+                self.settings.get_threads(), self.settings.get_settings_module(), bool(self.settings.get_proxy_backends()))
+
+    def warm_standby(self):
+        if self.standby or not self.settings.get_standby() or not self.settings.supports_standby():
+            return
+        if self.settings.get_proxy_backends():
+            self.standby = ServerProcess(self.settings, '127.0.0.1', find_free_port(), standby=True)
+        else:
+            self.standby = ServerProcess(self.settings, standby=True)
+        self.standby.signature = self.standby_signature()
+        self.connect_output(self.standby)
+        self.standby.exited.connect(lambda code, error, server=self.standby: self.standby_exited(server, error))
+        self.standby.park()
+
+    def take_standby(self):
+        standby, self.standby = self.standby, None
+        if standby.process.state() == QProcess.Running and standby.signature == self.standby_signature():
+            self.console.add_warning('Promoting the standby server' + ('.' if standby.warm else ', it is still warming up.'))
+            return standby
+        standby.close()
+
+    def discard_standby(self):
+        if self.standby:
+            self.standby.close()
+            self.standby = None
+
+    def standby_exited(self, server, error):
+        if server is self.standby:
+            self.standby = None
+            self.console.add_error('Standby server exited: ' + error if error else 'Standby server exited.')
+
+    def connect_output(self, server):
+        if not server.output_connected:
+            server.output_connected = True
+            server.lines_ready.connect(self.on_lines)
+            server.lines_ready.connect(self.store.append)
+            server.lines_ready.connect(self.metrics.feed)
+            server.dropped.connect(self.on_dropped)
+
+    def add_server(self, server):
+        self.connect_output(server)
+        server.status_changed.connect(lambda st, server=server: self.server_status(server, st))
+        server.exited.connect(lambda code, error, server=server: self.server_exited(server, code, error))
+        self.servers.append(server)
+
+    def close_servers(self, servers):
+        for server in list(servers):
+            servers.remove(server)
+            server.close()
 
     def start_process(self):
+        self.finish_span('Superseded')
+        self.start_span = profiler.span('service.start', backend=self.settings.get_backend())
         self.set_process_status('Stopped')
-        self.process.kill()
-        if self.settings.value('project_path'):
-            self.process.setWorkingDirectory(self.settings.value('project_path'))
-        cmdline = self.settings.get_cmdline()
-        self.process.start(cmdline[0], cmdline[1:])
-        app.aboutToQuit.connect(self.stop_process)
-        self.thread = QThread(app)
-        self.w = Worker(self.settings)
-        self.w.response[str].connect(self.port_response)
-        self.w.moveToThread(self.thread)
-        self.thread.started.connect(self.w.watch_port)
-        self.thread.start()
+        self.supervisor.reset()
+        for servers in (self.servers, self.retiring, self.draining):
+            self.close_servers(servers)
+        for server in self.create_servers():
+            self.add_server(server)
+        self.timing_recorded = False
+        if self.settings.get_proxy_backends() and not self.start_proxy():
+            return
+        for server in self.servers:
+            server.start()
+
+    def start_proxy(self):
+        mappings = self.settings.get_static_mappings()
+        self.proxy.static = StaticFiles(mappings) if mappings else None
+        if not self.proxy.is_running():
+            self.proxy.host, self.proxy.port = self.settings.get_host(), self.settings.get_port()
+            try:
+                self.proxy.start()
+            except OSError as e:
+                self.console.add_error('Could not listen on ' + self.settings.get_addr() + ': ' + str(e))
+                return False
+        self.update_backends()
+        return True
+
+    def update_backends(self):
+        servers = self.servers
+        if self.retiring:
+            if all(s.status == 'Ready' for s in self.servers):
+                # the new generation is warm, switch over in one go and let the old one drain
+                self.draining.extend(self.retiring)
+                self.retiring = []
+                self.drain_started = time.monotonic()
+                self.drain_timer.start()
+                self.console.add_warning('Switched traffic to the new servers.')
+            else:
+                servers = self.retiring
+        self.proxy.set_backends([server.backend for server in servers if server.backend and server.status == 'Ready'])
+
+    def check_drained(self):
+        for server in list(self.draining):
+            if server.backend.in_flight == 0 or time.monotonic() - self.drain_started > self.drain_timeout:
+                self.draining.remove(server)
+                server.close()
+        if not self.draining:
+            self.drain_timer.stop()
+
+    def server_status(self, server, st):
+        if server in self.retiring and st != 'Ready':
+            # an old server died while the new ones warm up, stop routing to it
+            self.update_backends()
+        if server not in self.servers:
+            return
+        if st == 'Ready' and not self.timing_recorded and server.readiness.timing:
+            self.timing_recorded = True
+            self.settings.add_startup_time(server.readiness.timing)
+            self.show_startup_times()
+        if st == 'Ready':
+            # park a replacement only once the service is up, so it doesn't compete with the start for CPU
+            self.warm_standby()
+        if self.proxy.is_running():
+            self.update_backends()
+        if not self.retiring and all(s.status == 'Ready' for s in self.servers):
+            self.finish_span('Ready')
+        statuses = [s.status for s in self.servers + self.retiring]
+        for status in ('Ready', 'Started', 'Stopped'):
+            if status in statuses:
+                if status != getattr(self, 'process_status', None):
+                    self.set_process_status(status)
+                break
+
+    def server_exited(self, server, code, error):
+        if server not in self.servers:
+            return
+        if server.parked and code == STANDBY_STALE_EXIT:
+            self.console.add_warning('The standby server had outdated code loaded, starting a fresh one.')
+            server.parked = False
+            server.start()
+            return
+        if error:
+            self.console.add_error(error)
+        else:
+            self.console.add_line('Process finished!')
+        if self.retiring:
+            # the new generation is broken, keep serving with the old one
+            self.console.add_error('Restart aborted, the current servers keep running.')
+            self.finish_span('Aborted')
+            self.close_servers(self.servers)
+            self.servers, self.retiring = self.retiring, []
+            self.update_backends()
+            return
+        delay = self.supervisor.on_exit(code, server.uptime()) if self.settings.get_auto_restart() else None
+        if delay is not None:
+            self.console.add_warning('Service exited with code %d, restarting in %.1fs.' % (code, delay))
+            QTimer.singleShot(int(delay * 1000), lambda: self.respawn(server))
+            return
+        if self.supervisor.reason:
+            self.console.add_error('Not restarting the service any more, ' + self.supervisor.reason + '.')
+        if not any(s.status != 'Stopped' for s in self.servers):
+            if self.supervisor.reason:
+                self.set_process_status('Failed')
+            self.finish_span('Failed')
+            self.validate_settings()
 
-    @pyqtSlot(str)
-    def port_response(self, str):
-        self.set_process_status(str)
+    def respawn(self, server):
+        # skip it if the user stopped or restarted the service in the meantime
+        if server in self.servers and server.status == 'Stopped' and not server.stopping:
+            server.start()
+
+    def show_startup_times(self):
+        history = self.settings.get_startup_history()
+        if history:
+            last = history[-1]
+            readies = sorted(entry['ready'] for entry in history)
+            self.startup_text.setText('Last start: bound in %.1fs, ready in %.1fs (median of last %d: %.1fs)' % (
+                last['bind'], last['ready'], len(readies), readies[len(readies) // 2]))
 
     def stop_process(self):
-        self.manual_stop = True
-        self.process.kill()
+        for server in self.servers:
+            server.kill()
+        for servers in (self.retiring, self.draining):
+            self.close_servers(servers)
+        self.proxy.stop()
+        self.finish_span('Stopped')
         self.set_process_status('Stopped')
         self.console.add_warning('Stopped process.')
 
+    def finish_span(self, status):
+        if self.start_span:
+            self.start_span.end(status=status)
+            self.start_span = None
+
     def add_content(self, *args, **kwargs):
-        self.console = Log()
+        self.console = Log(self.settings.get_log_max_lines())
         self.layout.addWidget(self.console)
         self.footer_layout = QHBoxLayout()
         self.footer_layout.addStretch(1)
         self.layout.addLayout(self.footer_layout)
+        self.startup_text = QLabel()
+        self.footer_layout.insertWidget(0, self.startup_text)
         status_label = QLabel('Status: ')
         self.status_text = QLabel()
         self.footer_layout.addWidget(status_label)
@@ -416,21 +1417,45 @@ class ServiceTab(Tab):
         self.stop_button.clicked.connect(self.stop_process)
         self.footer_layout.addWidget(self.start_button)
         self.footer_layout.addWidget(self.stop_button)
-        # self.restart_button = QPushButton('Restart')
-        # self.restart_button.clicked.connect(self.restart_process)
-        # self.footer_layout.addWidget(self.restart_button)
-        self.process = QProcess(app)
-        self.process.setReadChannel(QProcess.StandardOutput)
-        self.process.setProcessChannelMode(QProcess.MergedChannels)
-        self.process.readyRead.connect(self.on_ready)
-        self.process.readyReadStandardOutput.connect(self.on_ready)
-        self.process.error.connect(self.on_error)
-        self.process.finished.connect(self.on_finish)
+        self.history_button = QPushButton('History')
+        self.history_button.clicked.connect(self.show_history)
+        self.footer_layout.addWidget(self.history_button)
+        self.restart_button = QPushButton('Restart')
+        self.restart_button.clicked.connect(self.restart_process)
+        self.footer_layout.addWidget(self.restart_button)
+        self.store = LogStore(self.settings.get_log_dir())
+        app.aboutToQuit.connect(self.store.close)
+        self.metrics = RequestMetrics()
+        self.supervisor = Supervisor()
+        self.servers = []
+        # a rolling restart keeps the old generation serving (retiring) until the new one is ready,
+        # then lets it finish its in-flight requests (draining) before stopping it
+        self.retiring = []
+        self.draining = []
+        self.drain_timer = QTimer(self)
+        self.drain_timer.setInterval(100)
+        self.drain_timer.timeout.connect(self.check_drained)
+        # with proxy_backends set the cockpit owns the public port and spreads requests over that many servers
+        self.proxy = ReverseProxy(self.settings.get_host(), self.settings.get_port())
+        self.standby = None
+        self.start_span = None
+        self.show_startup_times()
+        app.aboutToQuit.connect(self.stop_process)
+        app.aboutToQuit.connect(self.discard_standby)
         # self.start_process()
 
-    def on_ready(self):
-        txt = str(self.process.readAll(), encoding='utf-8')
-        self.console.add_line(txt)
+    def on_lines(self, lines):
+        self.console.add_lines(lines)
+
+    def show_history(self):
+        if not hasattr(self, 'history'):
+            self.history = LogHistory(self.store, self)
+        self.history.show_latest()
+        self.history.show()
+        self.history.activateWindow()
+
+    def on_dropped(self, count):
+        self.console.add_warning('... ' + str(count) + ' lines of output dropped, the log view could not keep up ...')
 
     def validate_settings(self):
         if self.base.settings.is_valid():
@@ -441,26 +1466,90 @@ class ServiceTab(Tab):
             self.base.tray.show_tab(1)
             self.base.settings.warn()
 
-    def on_finish(self):
-        if not self.manual_stop:
-            error = str(self.process.readAllStandardError(), encoding='utf-8')
-            if error == '':
-                self.console.add_line('Process finished!')
-            else:
-                self.console.add_error(error)
-            self.validate_settings()
-        self.set_process_status('Stopped')
-        # self.manual_stop = True
 
-    def on_error(self):
-        if not self.manual_stop:
-            error = 'Error occurred while trying to run service.'
-            if not self.process.error() == 0:
-                error += str(self.process.error())
-            self.validate_settings()
-            self.console.add_error(error)
-        self.set_process_status('Stopped')
-        # self.manual_stop = True
+class LogHistory(QDialog):
+    page_lines = 500
+    # lines read per search slice, small enough that the dialog stays responsive in between
+    search_slice = 5000
+
+    def __init__(self, store, parent=None):
+        super(LogHistory, self).__init__(parent)
+        self.store = store
+        self.first = self.last = None
+        self.setWindowTitle('Service History')
+        self.resize(900, 600)
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+        self.console = Log(self.page_lines)
+        layout.addWidget(self.console)
+        buttons_layout = QHBoxLayout()
+        layout.addLayout(buttons_layout)
+        self.search = QLineEdit(returnPressed=self.find)
+        self.search.setPlaceholderText('Search')
+        buttons_layout.addWidget(self.search)
+        buttons_layout.addStretch(1)
+        for label, slot in (('Older', self.older), ('Newer', self.newer),
+                            ('Last 10 minutes', lambda: self.show_since(10 * 60)), ('Latest', self.show_latest)):
+            button = QPushButton(label)
+            button.clicked.connect(slot)
+            buttons_layout.addWidget(button)
+        self.search_position = None
+        self.search_timer = QTimer(self)
+        self.search_timer.timeout.connect(self.search_step)
+        self.finished.connect(self.search_timer.stop)
+
+    def show_page(self, lines, first, last):
+        self.search_timer.stop()
+        self.console.clear()
+        self.console.add_lines(lines)
+        self.first, self.last = first, last
+
+    def show_latest(self):
+        end = self.store.end()
+        if end:
+            lines, first = self.store.read_backward(end, self.page_lines)
+            self.show_page(lines, first, end)
+
+    def show_since(self, seconds):
+        start = self.store.locate_ago(seconds)
+        if start:
+            lines, last = self.store.read_forward(start, self.page_lines)
+            self.show_page(lines, start, last)
+            self.console.moveCursor(QTextCursor.Start)
+
+    def older(self):
+        if self.first:
+            lines, first = self.store.read_backward(self.first, self.page_lines)
+            if lines:
+                self.show_page(lines, first, self.first)
+
+    def newer(self):
+        if self.last:
+            lines, last = self.store.read_forward(self.last, self.page_lines)
+            if lines:
+                self.show_page(lines, self.last, last)
+                self.console.moveCursor(QTextCursor.Start)
+
+    def find(self):
+        self.search_timer.stop()
+        text = self.search.text()
+        if text:
+            self.console.clear()
+            self.first = self.last = None
+            # newest first, the store is read backward a slice per timer tick
+            self.search_text = text
+            self.search_found = 0
+            self.search_position = self.store.end()
+            if self.search_position:
+                self.search_timer.start(0)
+
+    def search_step(self):
+        matches, self.search_position = self.store.search(self.search_text, self.search_position,
+                                                          self.page_lines - self.search_found, self.search_slice)
+        self.console.add_lines(matches)
+        self.search_found += len(matches)
+        if self.search_position is None or self.search_found >= self.page_lines:
+            self.search_timer.stop()
 
 
 class SettingsTab(Tab):
@@ -542,6 +1631,33 @@ class SettingsTab(Tab):
         port_row.addWidget(port_label)
         port_row.addWidget(self.port_edit)
 
+        backend_row = QHBoxLayout()
+        self.layout.addLayout(backend_row)
+        backend_label = QLabel('Server', self)
+        self.backend_edit = QComboBox(self)
+        self.backend_edit.addItems(self.settings.backends)
+        self.backend_edit.setCurrentText(self.settings.get_backend())
+        workers_label = QLabel('Workers', self)
+        self.workers_edit = QLineEdit(self)
+        self.workers_edit.setText(str(self.settings.get_workers()))
+        self.workers_edit.setValidator(QIntValidator(1, 256, self))
+        threads_label = QLabel('Threads', self)
+        self.threads_edit = QLineEdit(self)
+        self.threads_edit.setText(str(self.settings.get_threads()))
+        self.threads_edit.setValidator(QIntValidator(1, 256, self))
+        backend_row.addWidget(backend_label)
+        backend_row.addWidget(self.backend_edit)
+        backend_row.addWidget(workers_label)
+        backend_row.addWidget(self.workers_edit)
+        backend_row.addWidget(threads_label)
+        backend_row.addWidget(self.threads_edit)
+        proxy_backends_label = QLabel('Proxied servers', self)
+        self.proxy_backends_edit = QLineEdit(self)
+        self.proxy_backends_edit.setText(str(self.settings.get_proxy_backends()))
+        self.proxy_backends_edit.setValidator(QIntValidator(0, 64, self))
+        backend_row.addWidget(proxy_backends_label)
+        backend_row.addWidget(self.proxy_backends_edit)
+
         buttons_layout = QHBoxLayout()
         buttons_layout.addStretch(1)
         self.layout.addLayout(buttons_layout)
@@ -584,6 +1700,10 @@ class SettingsTab(Tab):
         self.settings.setValue('remote_url', self.remote_url_edit.text())
         self.settings.setValue('host', self.host_edit.text())
         self.settings.setValue('port', self.port_edit.text())
+        self.settings.setValue('backend', self.backend_edit.currentText())
+        self.settings.setValue('workers', self.workers_edit.text())
+        self.settings.setValue('threads', self.threads_edit.text())
+        self.settings.setValue('proxy_backends', self.proxy_backends_edit.text())
         self.reset()
 
     def clear_layout(self, layout):
@@ -636,8 +1756,20 @@ class BackupTab(Tab):
         self.backup_button = QPushButton('Backup')
         self.backup_button.clicked.connect(self.backup)
         self.layout.addWidget(self.backup_button)
+        self.backup_progress = QProgressBar()
+        self.backup_progress.hide()
+        self.layout.addWidget(self.backup_progress)
         self.backup_message = QLabel('')
         self.layout.addWidget(self.backup_message)
+        self.schedule_text = QLabel('')
+        self.layout.addWidget(self.schedule_text)
+        self.show_schedule()
+        backups = self.base.backups
+        backups.started.connect(self.backup_started)
+        backups.progress.connect(self.backup_step)
+        backups.done.connect(self.backup_done)
+        backups.error.connect(self.backup_error)
+        backups.stats_changed.connect(self.show_schedule)
         self.check_backup_possible()
 
         self.layout.addWidget(QLabel('<h1>Restore</h1>'))
@@ -652,27 +1784,106 @@ class BackupTab(Tab):
         self.choose_restore_file_btn.clicked.connect(self.choose_restore_file)
         restore_file_row.addWidget(self.choose_restore_file_btn)
 
+        catalog_row = QHBoxLayout()
+        self.layout.addLayout(catalog_row)
+        catalog_row.addWidget(QLabel('<strong>Or one of the backups</strong>:'))
+        self.catalog_filter = QLineEdit()
+        self.catalog_filter.setPlaceholderText('Filter by path, migration or checksum')
+        self.catalog_filter.textChanged.connect(self.load_catalog)
+        catalog_row.addWidget(self.catalog_filter)
+        self.rescan_button = QPushButton('Rescan')
+        self.rescan_button.clicked.connect(self.rescan_catalog)
+        catalog_row.addWidget(self.rescan_button)
+        self.catalog_table = QTableWidget(0, 5)
+        self.catalog_table.setHorizontalHeaderLabels(['Taken', 'Kind', 'Size', 'Migrations', 'Source'])
+        self.catalog_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.catalog_table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.catalog_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.catalog_table.verticalHeader().hide()
+        self.catalog_table.horizontalHeader().setStretchLastSection(True)
+        self.layout.addWidget(self.catalog_table)
+        self.catalog_text = QLabel('')
+        self.layout.addWidget(self.catalog_text)
+        self.catalog_thread = None
+        app.aboutToQuit.connect(self.stop_catalog_scan)
+        self.load_catalog()
+
         restore_location_row = QHBoxLayout()
         self.layout.addLayout(restore_location_row)
         restore_location_row.addWidget(QLabel('<strong>Restoring as</strong>:'))
         restore_location_row.addWidget(QLabel(self.restore_location))
 
+        rollback_row = QHBoxLayout()
+        self.layout.addLayout(rollback_row)
+        rollback_row.addWidget(QLabel('<strong>Rollback points</strong>:'))
+        self.restore_thread = None
+        self.rollback_combo = QComboBox()
+        rollback_row.addWidget(self.rollback_combo)
+        self.rollback_button = QPushButton('Roll back')
+        self.rollback_button.clicked.connect(self.rollback)
+        rollback_row.addWidget(self.rollback_button)
+        self.load_rollback_points()
+
         self.restore_button = QPushButton('Restore')
         self.restore_button.clicked.connect(self.restore)
         self.layout.addWidget(self.restore_button)
+        self.restore_progress = QProgressBar()
+        self.restore_progress.hide()
+        self.layout.addWidget(self.restore_progress)
         self.restore_message = QLabel('')
         self.layout.addWidget(self.restore_message)
+        app.aboutToQuit.connect(self.cancel_restore)
+        self.catalog_table.itemSelectionChanged.connect(self.check_restore_possible)
         self.check_restore_possible()
+        self.rescan_if_empty()
 
     def backup(self):
-        try:
-            shutil.copy(self.backup_file, self.backup_dir)
-            self.backup_message.setText('<span style="color: green">' + 'Successfully backed up!' + '</span>')
-        except Exception as e:
-            self.backup_message.setText('<span style="color: red">' + str(e) + '</span>')
+        # the copy goes through sqlite on a worker thread, the service keeps writing meanwhile
+        if not self.base.backups.run(self.backup_file):
+            self.backup_message.setText('Another backup is running.')
+
+    def backup_started(self, source):
+        self.backup_button.setEnabled(False)
+        self.backup_progress.setValue(0)
+        self.backup_progress.show()
+        self.backup_message.setText('Backing up ' + source + '..')
+
+    def backup_step(self, done, total):
+        self.backup_progress.setMaximum(total)
+        self.backup_progress.setValue(done)
+
+    def backup_done(self, summary):
+        self.backup_progress.hide()
+        self.backup_message.setText('<span style="color: green">' + 'Successfully backed up! ' + summary + '</span>')
+        self.load_catalog()
+        self.check_backup_possible()
+
+    def backup_error(self, st):
+        self.backup_progress.hide()
+        self.backup_message.setText('<span style="color: red">' + st + '</span>')
         self.check_backup_possible()
 
+    def show_schedule(self):
+        schedule = []
+        if self.settings.get_backup_interval():
+            schedule.append('every %d minutes' % self.settings.get_backup_interval())
+        if self.settings.get_backup_cron():
+            schedule.append('at "%s"' % self.settings.get_backup_cron().expression)
+        text = '<strong>Scheduled</strong>: ' + (' and '.join(schedule) or 'off')
+        stats = self.settings.get_backup_stats()
+        if stats.get('last_run'):
+            text += ', last run %s (%s' % (time.strftime('%Y-%m-%d %H:%M', time.localtime(stats['last_run'])),
+                                           stats.get('last_result', ''))
+            if stats.get('last_duration') is not None:
+                text += ', took %.1fs' % stats['last_duration']
+            text += '), %d runs, %d skipped unchanged, %d failed' % (
+                stats.get('runs', 0), stats.get('skipped', 0), stats.get('failures', 0))
+        self.schedule_text.setText(text)
+
     def check_backup_possible(self):
+        if self.base.backups.is_running():
+            self.backup_button.setEnabled(False)
+            return False
         if self.backup_dir and self.backup_file and os.path.isfile(self.backup_file) and os.path.exists(
                 self.backup_dir) and os.path.isdir(self.backup_dir):
             self.backup_button.setEnabled(True)
@@ -703,6 +1914,8 @@ class BackupTab(Tab):
             self.settings.setValue('backup_dir', self.backup_dir)
             self.settings.endGroup()
             self.backup_dir_label.setText(self.backup_dir)
+            self.load_catalog()
+            self.rescan_if_empty()
         self.check_backup_possible()
 
     def choose_restore_file(self):
@@ -719,17 +1932,170 @@ class BackupTab(Tab):
         self.restore_file_label.setText(self.restore_file)
         self.check_restore_possible()
 
+    def load_catalog(self):
+        catalog = self.settings.get_backup_catalog()
+        entries = catalog.query(self.catalog_filter.text().strip()) if catalog else []
+        self.catalog_table.setRowCount(len(entries))
+        for row, entry in enumerate(entries):
+            cells = [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['created'])), entry['kind'],
+                     format_size(entry['size'] or 0), entry['migration'] or '', entry['source'] or '']
+            for column, text in enumerate(cells):
+                item = QTableWidgetItem(text)
+                item.setData(Qt.UserRole, entry['id'])
+                item.setToolTip(entry['path'] + '\nsha256 ' + (entry['sha256'] or ''))
+                self.catalog_table.setItem(row, column, item)
+        self.catalog_table.resizeColumnsToContents()
+        if not catalog:
+            self.catalog_text.setText('Choose a folder to back up to, to list its backups.')
+        else:
+            self.catalog_text.setText('%d backups shown.' % len(entries) if entries else 'No backups found.')
+
+    def rescan_if_empty(self):
+        catalog = self.settings.get_backup_catalog()
+        if catalog and not catalog.count():
+            # first use, a folder that already holds backups, or backups from before the catalog existed
+            self.rescan_catalog()
+
+    def rescan_catalog(self):
+        catalog = self.settings.get_backup_catalog()
+        if not catalog or self.catalog_thread:
+            return
+        self.catalog_thread = QThread(app)
+        self.catalog_worker = CatalogWorker(catalog, self.settings.get_backup_repository(), self.settings.get_backup_dir())
+        self.catalog_worker.done.connect(self.catalog_done)
+        self.catalog_worker.error.connect(self.catalog_error)
+        self.catalog_worker.moveToThread(self.catalog_thread)
+        self.catalog_thread.started.connect(self.catalog_worker.run)
+        self.catalog_thread.start()
+        self.rescan_button.setEnabled(False)
+        self.catalog_text.setText('Scanning ' + self.settings.get_backup_dir() + '..')
+
+    def stop_catalog_scan(self):
+        if self.catalog_thread:
+            self.catalog_worker.catalog.cancel()
+            self.catalog_thread.quit()
+            self.catalog_thread.wait()
+
+    def catalog_finished(self):
+        self.catalog_thread.quit()
+        self.catalog_thread.wait()
+        self.catalog_thread = None
+        self.rescan_button.setEnabled(True)
+
+    def catalog_done(self, count, duration):
+        self.catalog_finished()
+        self.load_catalog()
+        self.catalog_text.setText('%d backups found in %.1fs.' % (count, duration))
+
+    def catalog_error(self, st):
+        self.catalog_finished()
+        self.catalog_text.setText('<span style="color: red">' + st + '</span>')
+
+    def selected_backup(self):
+        items = self.catalog_table.selectedItems()
+        catalog = self.settings.get_backup_catalog()
+        if items and catalog:
+            return catalog.get(items[0].data(Qt.UserRole))
+
     def restore(self):
+        entry = self.selected_backup()
+        if entry and entry['kind'] == 'snapshot':
+            repository = self.settings.get_backup_repository()
+            snapshot = repository.get(entry['id'].split(':', 1)[1])
+            if not snapshot:
+                # pruned since the catalog was last updated
+                self.settings.get_backup_catalog().remove([entry['id']])
+                self.load_catalog()
+                self.restore_message.setText('<span style="color: red">The snapshot no longer exists.</span>')
+                return
+            self.start_restore(RestoreWorker(self.restore_location, repository=repository, snapshot=snapshot),
+                               entry['id'])
+        else:
+            source = entry['path'] if entry else self.restore_file
+            self.start_restore(RestoreWorker(self.restore_location, source=source), source)
+
+    def rollback(self):
+        path = self.rollback_combo.currentData()
+        reply = QMessageBox.question(self, 'Roll back', 'Replace the database with the rollback point taken ' +
+                                     self.rollback_combo.currentText() + '?', QMessageBox.Yes | QMessageBox.No,
+                                     QMessageBox.No)
+        if reply == QMessageBox.Yes:
+            self.start_restore(RestoreWorker(self.restore_location, source=path), path)
+
+    def load_rollback_points(self):
+        self.rollback_combo.clear()
+        points = self.settings.get_rollback_points()
+        for point in points.points() if points else []:
+            self.rollback_combo.addItem('%s, %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(point['created'])),
+                                                    point['reason']), point['path'])
+        self.rollback_button.setEnabled(self.rollback_combo.count() > 0 and not self.restore_thread)
+
+    def start_restore(self, worker, source):
+        # the backup is copied and checked beside the database first, the service only stops for the swap
+        self.restore_worker = worker
+        self.restore_span = profiler.span('restore', source=source)
+        self.restore_thread = QThread(app)
+        self.restore_worker.progress.connect(self.restore_step)
+        self.restore_worker.ready.connect(self.restore_ready)
+        self.restore_worker.error.connect(self.restore_error)
+        self.restore_worker.moveToThread(self.restore_thread)
+        self.restore_thread.started.connect(self.restore_worker.run)
+        self.restore_thread.start()
+        self.restore_button.setEnabled(False)
+        self.rollback_button.setEnabled(False)
+        self.restore_progress.setValue(0)
+        self.restore_progress.show()
+        self.restore_message.setText('Copying and checking the backup..')
+
+    def cancel_restore(self):
+        if self.restore_thread:
+            self.restore_worker.restore.cancel()
+            self.restore_thread.quit()
+            self.restore_thread.wait()
+
+    def restore_step(self, done, total):
+        self.restore_progress.setMaximum(total)
+        self.restore_progress.setValue(done)
+
+    def restore_ready(self):
+        self.restore_finished()
+        service = self.tab_widget.cockpit.service_tab
+        was_running = service.process_status in ('Started', 'Ready')
+        if was_running:
+            service.stop_process()
+        # the standby may hold a connection to the old file
+        service.discard_standby()
         try:
-            shutil.copy(self.restore_file, self.restore_location)
+            self.restore_worker.restore.swap()
+            self.restore_span.end(status='Done')
             self.restore_message.setText('<span style="color: green">' + 'Successfully restored!' + '</span>')
-        except Exception as e:
+        except OSError as e:
+            self.restore_worker.restore.discard()
+            self.restore_span.end(status='Failed')
             self.restore_message.setText('<span style="color: red">' + str(e) + '</span>')
+        if was_running:
+            service.start_process()
+        self.check_restore_possible()
+
+    def restore_error(self, st):
+        self.restore_finished()
+        self.restore_span.end(status='Failed')
+        self.restore_message.setText('<span style="color: red">' + st + '</span>')
         self.check_restore_possible()
 
+    def restore_finished(self):
+        self.restore_thread.quit()
+        self.restore_thread.wait()
+        self.restore_thread = None
+        self.restore_progress.hide()
+
     def check_restore_possible(self):
-        if self.restore_location and self.restore_file and os.path.isfile(self.restore_file) and os.path.exists(
-                os.path.dirname(self.restore_location)):
+        if self.restore_thread:
+            self.restore_button.setEnabled(False)
+            return False
+        self.rollback_button.setEnabled(self.rollback_combo.count() > 0)
+        chosen = self.catalog_table.selectedItems() or self.restore_file and os.path.isfile(self.restore_file)
+        if self.restore_location and chosen and os.path.exists(os.path.dirname(self.restore_location)):
             self.restore_button.setEnabled(True)
             return True
         else:
@@ -754,6 +2120,10 @@ class UpdatesTab(Tab):
         self.layout.addWidget(self.update_btn)
         self.update_txt = QLabel('')
         self.layout.addWidget(self.update_txt)
+        self.download_progress = QProgressBar()
+        self.download_progress.hide()
+        self.layout.addWidget(self.download_progress)
+        app.aboutToQuit.connect(self.cancel_download)
 
     def get_remote_version(self):
         self.thread = QThread(app)
@@ -781,7 +2151,8 @@ class UpdatesTab(Tab):
         self.add_warning('Getting download url..')
         self.thread = QThread(app)
         self.w = Worker(self.settings)
-        self.w.download_response[bytes].connect(self.on_response_download)
+        self.w.download_response[str].connect(self.on_response_download)
+        self.w.download_progress.connect(self.download_step)
         self.w.error[str].connect(self.download_error)
         self.w.moveToThread(self.thread)
         self.thread.started.connect(self.w.download_update)
@@ -797,51 +2168,52 @@ class UpdatesTab(Tab):
         else:
             self.update_btn.setEnabled(True)
 
-    def on_response_download(self, zip_content):
+    def cancel_download(self):
+        # the .part file stays behind and the next update resumes from it
+        download = getattr(getattr(self, 'w', None), 'download', None)
+        if download:
+            download.cancel()
+
+    def download_step(self, done, total):
+        self.download_progress.setMaximum(total)
+        self.download_progress.setValue(done)
+        self.download_progress.show()
+
+    def on_response_download(self, zip_path):
         self.thread.quit()
+        self.download_progress.hide()
         self.add_success('Downloading completed.')
+        self.base.take_rollback_point('Before update to ' + self.remote_version, lambda: self.install(zip_path))
+
+    def install(self, zip_path):
+        with profiler.span('update.install', size=os.path.getsize(zip_path)):
+            self.install_update(zip_path)
+        os.remove(zip_path)
 
-        tmp_dir = tempfile.gettempdir()
-        timestamp = str(time.time())
-        ext_dir = os.path.join(tmp_dir, timestamp)
-        os.makedirs(ext_dir, exist_ok=True)
-        zip_bytes = BytesIO(zip_content)
-        zip_file = zipfile.ZipFile(zip_bytes)
+    def install_update(self, zip_path):
         self.project_path = self.settings.value('project_path')
-        error = False
-        self.add_text('Extracting to temporary directory')
-        for name in zip_file.namelist():
-            if name:
-                try:
-                    zip_file.extract(name, ext_dir)
-                except Exception as e:
-                    self.add_error(str(e))
-                    self.add_error('Aborted!')
-                    error = True
-                    break
-        if not error:
-            self.add_success('Extracting completed.')
-            self.add_success('Cleaning pyc files...')
-            clean_pyc(self.settings.value('project_path'))
+        update = DeltaUpdate(zip_path, self.project_path)
+        self.add_text('Comparing with project files...')
+        try:
+            plan = update.plan()
+            self.add_text('%d added, %d changed, %d removed, %d unchanged.' % (
+                len(plan['added']), len(plan['changed']), len(plan['removed']), len(plan['unchanged'])))
             self.add_success('Replacing project files...')
-            ext_content = os.listdir(ext_dir)
-            if not len(ext_content) == 1:
-                self.add_error("Extracted zip file doesn't have one and only one root folder.")
-                self.add_error('Aborted!')
-                return
-            ext_root_dir = os.path.join(ext_dir, ext_content[0])  # get the root folder
-            try:
-                move_files(ext_root_dir, self.project_path)
-            except Exception as e:
-                self.add_error('Error' + str(e))
-                self.add_error("Replacing of project files failed!")
-                self.add_error('Aborted!')
-            self.update_local_version()
-            shutil.rmtree(ext_dir)
-            self.add_success('Update complete!')
+            update.apply(plan)
+        except Exception as e:
+            self.add_error('Error: ' + str(e))
+            self.add_error("Replacing of project files failed!")
+            self.add_error('Aborted!')
+            return
+        self.update_local_version()
+        if plan['added'] or plan['changed'] or plan['removed']:
+            # the standby has the old code loaded
+            self.tab_widget.cockpit.service_tab.discard_standby()
+        self.add_success('Update complete!')
 
     def download_error(self, st):
         self.thread.quit()
+        self.download_progress.hide()
         self.add_error('Error downloading update file.')
         self.add_error(st)
 
@@ -879,6 +2251,9 @@ class ToolsTab(Tab):
         self.check_port_status()
 
     def run_migrations(self):
+        self.base.take_rollback_point('Before migrations', self.migrate)
+
+    def migrate(self):
         call_command([self.settings.get_python_path(), 'manage.py', 'migrate'], cwd=self.settings.value('project_path'))
 
     def open_shell(self):
@@ -891,8 +2266,9 @@ class ToolsTab(Tab):
         clean_pyc(self.settings.value('project_path'))
 
     def free_port_action(self):
+        for server in self.tab_widget.cockpit.service_tab.servers:
+            server.stopping = True
         free_port(self.settings.get_port())
-        self.tab_widget.cockpit.service_tab.manual_stop = True
         self.tab_widget.cockpit.service_tab.console.add_warning(
             'Port ' + str(self.settings.get_port()) + ' is now free.')
         self.check_port_status()
@@ -924,257 +2300,138 @@ class AboutTab(Tab):
 
 
 class ConsoleTab(Tab):
+    lazy = False
+
     def add_content(self):
-        self.console = Log()
+        self.console = Log(self.settings.get_log_max_lines())
         self.layout.addWidget(self.console)
 
 
-class WebPage(QWebPage):
-    console_message = pyqtSignal(str, int, str)
-
-    def javaScriptConsoleMessage(self, msg, line, source):
-        self.console_message.emit(msg, line, source)
-
-
-class WebView(QWebView):
-    def __init__(self, *args, **kwargs):
-        super(WebView, self).__init__(*args, **kwargs)
-        self._page = WebPage()
-        self._page.setForwardUnsupportedContent(True)
-
-        self.setPage(self._page)
-
-    def contextMenuEvent(self, event):
-        pass
+class Sparkline(QWidget):
+    def __init__(self, color='#2a82da', *args, **kwargs):
+        super(Sparkline, self).__init__(*args, **kwargs)
+        self.color = QColor(color)
+        self.values = []
+        self.setMinimumHeight(40)
 
+    def set_values(self, values):
+        self.values = values
+        self.update()
 
-class WebBrowser(QMainWindow):
-    printer = None
-    downloading = False
-
-    def i(self, ico):
-        return self.style().standardIcon(ico)
-
-    def __init__(self, base):
-        QMainWindow.__init__(self)
-        self.base = base
-        self.setWindowIcon(self.base.app_icon)
-        self.setWindowTitle(self.base.settings.get_title())
-        QWebSettings.globalSettings().setAttribute(QWebSettings.DeveloperExtrasEnabled, True)
-
-        self.pbar = QProgressBar()
-        self.pbar.setMaximumWidth(120)
-        self.wb = WebView(loadProgress=self.pbar.setValue, loadFinished=self.load_finished,
-                          loadStarted=self.load_started,
-                          titleChanged=self.change_title)
-        self.setCentralWidget(self.wb)
-        self.wb.page().unsupportedContent.connect(self.download)
-        # self.wb.page().downloadRequested.connect(lambda req: self.download(self.wb.page().networkAccessManager().get(req)))
-
-        self.cookies = QtNetwork.QNetworkCookieJar(app)
-        self.wb.page().networkAccessManager().setCookieJar(self.cookies)
-        self.cookies.setAllCookies(QtNetwork.QNetworkCookie.parseCookies(self.base.settings.get_cookies()))
-
-        self.tb = self.addToolBar('Main Toolbar')
-        for a in (QWebPage.Back, QWebPage.Forward, QWebPage.Reload):
-            self.tb.addAction(self.wb.pageAction(a))
-        home_action = QAction(self.i(QStyle.SP_DirHomeIcon), 'Home', self)
-        home_action.triggered.connect(self.load)
-        self.tb.addAction(home_action)
-        self.tb.addSeparator()
-        print_action = QAction(QIcon.fromTheme('document-print'), 'Print', self)
-        # print_action.setShortcut('Ctrl+P')
-        print_action.triggered.connect(self.print_dialog)
-        self.tb.addAction(print_action)
-        print_preview_action = QAction(QIcon.fromTheme('document-print-preview'), 'Print Preview', self)
-        print_preview_action.triggered.connect(self.print_preview)
-        self.tb.addAction(print_preview_action)
-        print_pdf_action = QAction(QIcon.fromTheme('document-save'), 'Save as PDF', self)
-        print_pdf_action.triggered.connect(self.print_pdf)
-        self.tb.addAction(print_pdf_action)
-        self.tb.addSeparator()
-
-        self.search = QLineEdit(
-            returnPressed=lambda: self.wb.findText(self.search.text(), QWebPage.FindWrapsAroundDocument))
-        self.search.setPlaceholderText('Search')
-        QShortcut("Ctrl+F", self, activated=self.toggle_search_focus)
-        QShortcut("Esc", self, activated=self.remove_search_focus)
-        self.search.setMaximumWidth(250)
-        self.search_action = self.tb.addWidget(self.search)
-        # self.hide_search()
-
-        QShortcut("Ctrl+Q", self, activated=self.close)
-        QShortcut("Ctrl+W", self, activated=self.close)
-        QShortcut("F11", self, activated=self.switch_full_screen)
-        QShortcut("Backspace", self, activated=lambda: self.wb.triggerPageAction(QWebPage.Back))
-        QShortcut("Alt+Left", self, activated=lambda: self.wb.triggerPageAction(QWebPage.Back))
-        QShortcut("Alt+Right", self, activated=lambda: self.wb.triggerPageAction(QWebPage.Forward))
-        QShortcut("Ctrl+R", self, activated=lambda: self.wb.triggerPageAction(QWebPage.Reload))
-        QShortcut("Ctrl+Shift+R", self, activated=lambda: self.wb.triggerPageAction(QWebPage.ReloadAndBypassCache))
-        QShortcut("Ctrl+=", self, activated=lambda: self.wb.setZoomFactor(self.wb.zoomFactor() + .2))
-        QShortcut("Ctrl+-", self, activated=lambda: self.wb.setZoomFactor(self.wb.zoomFactor() - .2))
-        QShortcut("Ctrl+0", self, activated=lambda: self.wb.setZoomFactor(1))
-        QShortcut("Ctrl+P", self, activated=self.print_dialog)
-        QShortcut("Ctrl+Shift+P", self, activated=self.print_preview)
-        QShortcut("Ctrl+Shift+E", self, activated=self.print_pdf)
-        QShortcut("Ctrl+Shift+J", self, activated=self.show_dev_tools)
-        QShortcut("Ctrl+Shift+Q", self, activated=self.base.quit)
-
-        self.wb.page().console_message.connect(self.console_message)
-        self.wb.page().printRequested.connect(self.print_dialog)
-        self.wb.settings().setAttribute(QWebSettings.PluginsEnabled, True)
-        self.init_printer()
-
-    def download(self, reply):
-        self.downloading = True
-        destination = QFileDialog.getSaveFileName(self, "Save File",
-                                                  os.path.expanduser(os.path.join('~', str(reply.url().path()).split('/')[-1])))
-        if destination[0]:
-            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(to_pycookiejar(self.cookies)))
-            try:
-                with opener.open(reply.url().toString()) as response:
-                    with open(destination[0], 'wb') as f:
-                        f.write(response.read())
-            except Exception as e:
-                QMessageBox.critical(None, 'Saving Failed!', str(e), QMessageBox.Ok)
-
-    def init_printer(self):
-        if not self.printer:
-            self.printer = QPrinter(QPrinterInfo.defaultPrinter(), QPrinter.HighResolution)
-            self.printer.setOrientation(QPrinter.Portrait)
-            self.printer.setPaperSize(QPrinter.A4)
-        return self.printer
-
-    def print(self):
-        self.wb.print_(self.printer)
-
-    def print_pdf(self):
-        self.printer.setOutputFormat(QPrinter.PdfFormat)
-        chosen_file = QFileDialog.getSaveFileName(self, 'Save file', '', '.pdf', self.wb.title())
-        file_name = ''.join(chosen_file)
-        self.printer.setOutputFileName(file_name)
-        self.wb.print_(self.printer)
-
-    def print_dialog(self):
-        dialog = QPrintDialog(self.printer)
-        dialog.setWindowTitle('Print')
-        if dialog.exec_() != QDialog.Accepted:
+    def paintEvent(self, event):
+        if len(self.values) < 2:
             return
-        self.print()
-
-    def print_preview(self):
-        dialog = QPrintPreviewDialog(self.printer)
-        dialog.setWindowState(Qt.WindowMaximized)
-        dialog.paintRequested.connect(self.print)
-        dialog.setWindowFlags(
-            Qt.CustomizeWindowHint | Qt.WindowTitleHint | Qt.WindowMinMaxButtonsHint | Qt.WindowCloseButtonHint | Qt.WindowContextHelpButtonHint)
-        dialog.exec()
-
-    def show_dev_tools(self):
-        self.inspector = QWebInspector(self)
-        self.inspector.setPage(self.wb.page)
-        self.dev_tools = QDialog()
-        self.dev_tools_layout = QVBoxLayout()
-        self.dev_tools_layout.addWidget(self.inspector)
-        self.dev_tools.setLayout(self.dev_tools_layout)
-        self.dev_tools.setModal(False)
-        self.dev_tools.show()
-        self.dev_tools.activateWindow()
-        QShortcut("Ctrl+W", self.dev_tools, activated=self.dev_tools.close)
-
-    def console_message(self, msg, line, source):
-        self.base.cockpit.console_tab.console.add_line('%s line %d: %s' % (source, line, msg))
-
-    def load_started(self):
-        self.pbar.show()
-        self.pbar_action = self.tb.addWidget(self.pbar)
-
-    def load_finished(self, result):
-        self.pbar.hide()
-        self.tb.removeAction(self.pbar_action)
-        self.save_cookies()
-        if not self.downloading and not result:
-            self.wb.page().mainFrame().setHtml("<html><head><title>Error loading page</title></head>\
-         <body><h1>Error loading " + self.base.settings.get_local_url() + "</h2></body> </html>")
-        self.downloading = False
-
-    def toggle_search(self):
-        if self.search.isVisible():
-            self.hide_search()
-        else:
-            self.show_search()
-
-    def toggle_search_focus(self):
-        if self.search.hasFocus():
-            self.wb.setFocus()
-        else:
-            self.search.setFocus()
-
-    def remove_search_focus(self):
-        self.wb.setFocus()
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(QPen(self.color, 1.5))
+        width, height = self.width() - 2, self.height() - 2
+        top = max(self.values) or 1
+        step = width / float(len(self.values) - 1)
+        points = [QPointF(1 + i * step, 1 + height - height * value / float(top)) for i, value in enumerate(self.values)]
+        painter.drawPolyline(*points)
+        painter.end()
 
-    def show_search(self):
-        self.search.show()
-        self.search_action = self.tb.addWidget(self.search)
-        self.search.setFocus()
 
-    def hide_search(self):
-        self.search.hide()
-        self.tb.removeAction(self.search_action)
+class MetricsTab(Tab):
+    span = 5 * 60
 
-    def switch_full_screen(self):
-        if self.isFullScreen():
-            self.showMaximized()
+    def add_content(self):
+        self.metrics = self.tab_widget.cockpit.service_tab.metrics
+        self.rate_text = QLabel()
+        self.layout.addWidget(self.rate_text)
+        self.rate_line = Sparkline()
+        self.layout.addWidget(self.rate_line)
+        self.status_text = QLabel()
+        self.layout.addWidget(self.status_text)
+        self.error_line = Sparkline('red')
+        self.layout.addWidget(self.error_line)
+        self.latency_text = QLabel()
+        self.layout.addWidget(self.latency_text)
+        self.supervisor_text = QLabel()
+        self.layout.addWidget(self.supervisor_text)
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        super(MetricsTab, self).showEvent(event)
+        self.refresh()
+        self.timer.start()
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super(MetricsTab, self).hideEvent(event)
+
+    def refresh(self):
+        now = time.time()
+        self.rate_text.setText('<strong>Requests/sec</strong> (last 10s): %.2f, total: %d' % (
+            self.metrics.requests_per_second(10, now), self.metrics.total))
+        self.rate_line.set_values(self.metrics.series(self.span, now))
+        counts = self.metrics.status_counts(60, now)
+        self.status_text.setText('<strong>Responses</strong> (last minute): ' + ', '.join(
+            '%s: %d' % (key, counts[key]) for key in sorted(counts)) + ', %d KB sent' % (
+                                     self.metrics.bytes_sent(60, now) / 1024))
+        errors = [a + b for a, b in zip(self.metrics.series(self.span, now, '4xx'),
+                                        self.metrics.series(self.span, now, '5xx'))]
+        self.error_line.set_values(errors)
+        percentiles = self.metrics.percentiles(60, now)
+        if percentiles:
+            self.latency_text.setText('<strong>Latency</strong> (last minute): ' + ', '.join(
+                'p%d: %.1f ms' % (p, percentiles[p]) for p in sorted(percentiles)))
         else:
-            self.showFullScreen()
-
-    def show_window(self):
-        self.load()
-        try:
-            from win32gui import SetWindowPos
-            import win32con
-
-            SetWindowPos(self.winId(),
-                         win32con.HWND_TOPMOST,
-                         # = always on top. only reliable way to bring it to the front on windows
-                         0, 0, 0, 0,
-                         win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
-            SetWindowPos(self.winId(),
-                         win32con.HWND_NOTOPMOST,  # disable the always on top, but leave window at its top position
-                         0, 0, 0, 0,
-                         win32con.SWP_NOMOVE | win32con.SWP_NOSIZE | win32con.SWP_SHOWWINDOW)
-        except ImportError:
-            pass
-
-        self.raise_()
-        self.showMaximized()
-        self.setWindowState(self.windowState() & ~Qt.WindowMinimized | Qt.WindowActive)
-        self.activateWindow()
-
-    def load(self, url=None):
-        url = url or self.base.settings.get_local_url()
-        self.wb.load(QUrl(url))
-
-    def change_title(self):
-        self.setWindowTitle(self.wb.title() + ' | ' + self.base.settings.get_title())
-
-        # def closeEvent(self, event):
-        #     event.ignore()
-        #     self.hide()
+            self.latency_text.setText('<strong>Latency</strong>: not reported by the server')
+        service_tab = self.tab_widget.cockpit.service_tab
+        supervisor = service_tab.supervisor
+        uptime = max([server.uptime() for server in service_tab.servers] or [0])
+        text = '<strong>Service</strong>: up %dh %02dm, %d automatic restarts' % (
+            uptime // 3600, uptime % 3600 // 60, supervisor.restarts)
+        if supervisor.exits:
+            exited_at, code, ran = supervisor.exits[-1]
+            text += ', last exit code %d at %s after %ds' % (code, time.strftime('%H:%M:%S', time.localtime(exited_at)), ran)
+        self.supervisor_text.setText(text)
+
+
+class DiagnosticsTab(Tab):
+    def add_content(self):
+        self.layout.addWidget(QLabel('<h1>Diagnostics</h1>'))
+        self.startup_text = QLabel('')
+        self.layout.addWidget(self.startup_text)
+        self.summary_text = QLabel('')
+        self.layout.addWidget(self.summary_text)
+        refresh_button = QPushButton('Refresh')
+        refresh_button.clicked.connect(self.refresh)
+        self.layout.addWidget(refresh_button)
 
-    def save_cookies(self):
-        self.base.settings.set_cookies([str(c.toRawForm(), encoding='utf-8') + "\n" for c in self.cookies.allCookies()])
+    def on_active(self):
+        self.refresh()
+
+    def refresh(self):
+        startup = profiler.last_session('startup') + profiler.last_session('tab.')
+        rows = ''.join('<tr><td>%s</td><td align="right">%.1f ms</td></tr>' % (entry['name'], entry['ms'])
+                       for entry in startup)
+        self.startup_text.setText('<strong>This launch</strong><table>' + rows + '</table>')
+        rows = ''.join('<tr><td>%s</td><td align="right">%d</td><td align="right">%.1f</td><td align="right">%.1f</td>'
+                       '<td align="right">%.1f</td><td align="right">%.1f</td></tr>'
+                       % (row['name'], row['count'], row['last'], row['median'], row['p95'], row['max'])
+                       for row in profiler.summary())
+        self.summary_text.setText('<strong>All recorded</strong> (ms)<table cellspacing="6"><tr><th align="left">Span</th>'
+                                  '<th>Count</th><th>Last</th><th>Median</th><th>95%</th><th>Max</th></tr>' + rows +
+                                  '</table>')
 
 
 class DRBase(object):
     browser_waiting = True
+    _browser = None
+    rollback_thread = None
 
     def __init__(self, *args, **kwargs):
+        self.rollback_queue = []
         self.app_icon = self.set_icon()
-        self.settings = Settings(self)
+        with profiler.span('startup.settings'):
+            self.settings = Settings(self)
         if self.settings.exists:
-            self.browser = WebBrowser(self)
             self.status_text = 'Loading ...'
+            self.backups = BackupScheduler(self.settings)
             self.cockpit = Cockpit(self)
             self.tray = Tray(self)
             self.cockpit.service_status.connect(self.tray.service_status)
@@ -1182,6 +2439,61 @@ class DRBase(object):
         else:
             return sys.exit()
 
+    def take_rollback_point(self, reason, then):
+        """Take a rollback point, then call `then` once it is on disk (or failed, which is only reported)."""
+        points = self.settings.get_rollback_points()
+        if not points:
+            return then()
+        if self.rollback_thread:
+            # gets its own point once the running one is done
+            self.rollback_queue.append((reason, then))
+            return
+        try:
+            # a reflink clone takes milliseconds, only a full copy is worth a thread. The server may hold
+            # the write lock, so the GUI only waits briefly for it before leaving it to the thread as well.
+            point = points.take(reason, fallback=False, timeout=0.1) if points.can_clone() else None
+        except Exception as e:
+            self.rollback_failed(str(e))
+            return then()
+        if point:
+            self.rollback_taken(point)
+            return then()
+        self.cockpit.service_tab.console.add_line('Taking rollback point "%s"...' % reason)
+        self.rollback_thread = QThread(app)
+        self.rollback_worker = RollbackWorker(points, reason)
+        self.rollback_worker.moveToThread(self.rollback_thread)
+        self.rollback_worker.done.connect(self.rollback_taken)
+        self.rollback_worker.error.connect(self.rollback_failed)
+        self.rollback_worker.done.connect(lambda point: self.rollback_finished(then))
+        self.rollback_worker.error.connect(lambda st: self.rollback_finished(then))
+        self.rollback_thread.started.connect(self.rollback_worker.run)
+        self.rollback_thread.start()
+
+    def rollback_finished(self, then):
+        self.rollback_thread.quit()
+        self.rollback_thread.wait()
+        self.rollback_thread = None
+        then()
+        while self.rollback_queue and not self.rollback_thread:
+            self.take_rollback_point(*self.rollback_queue.pop(0))
+
+    def rollback_taken(self, point):
+        self.cockpit.service_tab.console.add_warning('Rollback point "%s" taken in %d ms (%s).' % (
+            point['reason'], point['duration'] * 1000, point['method']))
+        if self.cockpit.backup_tab.built:
+            self.cockpit.backup_tab.load_rollback_points()
+
+    def rollback_failed(self, st):
+        self.cockpit.service_tab.console.add_error('Could not take a rollback point: ' + st)
+
+    @property
+    def browser(self):
+        # WebKit is heavy to load, a cockpit started in the tray may never need it
+        if not self._browser:
+            from browser import WebBrowser
+            self._browser = WebBrowser(self)
+        return self._browser
+
     def quit(self):
         return QCoreApplication.instance().quit()
 
@@ -1196,7 +2508,7 @@ class DRBase(object):
         return app_icon
 
     def browser_or_cockpit(self):
-        if self.cockpit.service_tab.process_status == 'Started':
+        if self.cockpit.service_tab.process_status == 'Ready':
             self.browser.show_window()
         else:
             self.tray.show_tab(0)
@@ -1240,6 +2552,8 @@ class Cockpit(QMainWindow):
             self.updates_tab = UpdatesTab(tab_widget=tab_widget)
         self.tools_tab = ToolsTab(tab_widget=tab_widget)
         self.console_tab = ConsoleTab(tab_widget=tab_widget)
+        self.metrics_tab = MetricsTab(tab_widget=tab_widget)
+        self.diagnostics_tab = DiagnosticsTab(tab_widget=tab_widget)
         self.about_tab = AboutTab(tab_widget=tab_widget)
         self.widget.layout().addWidget(tab_widget)
         return tab_widget
@@ -1317,8 +2631,7 @@ class Application(QApplication):
     def __init__(self, argv):
         QApplication.__init__(self, argv)
         # self.create_mutex(argv)
-        self.socket_filename = str(os.path.expanduser("~/.ipc_%s"
-                                                      % self.generate_ipc_id()))
+        self.socket_filename = self.get_socket_filename()
         self.shared_mem = QSharedMemory()
         self.shared_mem.setKey(self.socket_filename)
 
@@ -1348,11 +2661,33 @@ class Application(QApplication):
             if os.path.exists(self.socket_filename):
                 os.remove(self.socket_filename)
 
-    def generate_ipc_id(self, channel=None):
+    @classmethod
+    def generate_ipc_id(cls, channel=None):
         if channel is None:
             channel = os.path.basename(sys.argv[0])
         return "%s_%s" % (channel, getpass.getuser())
 
+    @classmethod
+    def get_socket_filename(cls):
+        return str(os.path.expanduser("~/.ipc_%s" % cls.generate_ipc_id()))
+
+    @classmethod
+    def forward(cls, message):
+        # runs before any QApplication exists, so a second launch costs no more than the imports
+        shared_mem = QSharedMemory()
+        shared_mem.setKey(cls.get_socket_filename())
+        if not shared_mem.attach():
+            return False
+        shared_mem.detach()
+        socket = QLocalSocket()
+        socket.connectToServer(cls.get_socket_filename(), QIODevice.WriteOnly)
+        if not socket.waitForConnected(cls.timeout):
+            return False
+        socket.write(pickle.dumps(message))
+        sent = socket.waitForBytesWritten(cls.timeout)
+        socket.disconnectFromServer()
+        return sent
+
     def send_message(self, message):
         if not self.is_running:
             raise Exception("Client cannot connect to IPC server. Not running.")
@@ -1413,39 +2748,120 @@ class Application(QApplication):
             #         print("Unexpected error:", )
 
 
+class LogWriter(object):
+    flush_bytes = 64 * 1024
+    flush_interval = 0.5
+    FLUSH = object()
+
+    def __init__(self):
+        self.closed = False
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, files, obj):
+        if self.closed:
+            # late prints after shutdown go straight through
+            self.write([(files, obj)])
+        else:
+            self.queue.put((files, obj))
+
+    def request_flush(self):
+        self.queue.put(self.FLUSH)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.closed = True
+
+    def run(self):
+        pending = []
+        size = 0
+        deadline = None
+        done = False
+        while not done:
+            timeout = max(0, deadline - time.monotonic()) if pending else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = self.FLUSH
+            if item is None:
+                done = True
+            elif item is not self.FLUSH:
+                pending.append(item)
+                size += len(item[1])
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if pending and (done or item is self.FLUSH or size >= self.flush_bytes or time.monotonic() >= deadline):
+                self.write(pending)
+                pending = []
+                size = 0
+                deadline = None
+
+    def write(self, pending):
+        touched = set()
+        for files, obj in pending:
+            for f in files:
+                try:
+                    f.write(obj)
+                    touched.add(f)
+                except (OSError, ValueError):
+                    pass
+        for f in touched:
+            try:
+                f.flush()
+            except (OSError, ValueError):
+                pass
+
+
 class Tee(object):
-    def __init__(self, *files):
-        self.files = files
+    def __init__(self, writer, *files):
+        self.writer = writer
+        self.files = [f for f in files if f]
 
     def write(self, obj):
-        for f in self.files:
-            f.write(obj)
-            f.flush()  # If you want the output to be visible immediately
+        self.writer.put(self.files, obj)
 
     def flush(self):
-        for f in self.files:
-            f.flush()
+        self.writer.request_flush()
 
 
 if __name__ == '__main__':
-    app = Application(sys.argv)
+    # a second launch only hands its arguments to the running cockpit, before any window or process is created
+    if Application.forward(sys.argv):
+        sys.exit(0)
+    startup = profiler.span('startup')
+    with profiler.span('startup.application'):
+        app = Application(sys.argv)
     signal.signal(signal.SIGINT, signal.SIG_DFL)
-    base = DRBase()
-    app.new_connection.connect(base.browser_or_cockpit)
-    app.setQuitOnLastWindowClosed(False)
-    f = open(os.path.join(BASE_PATH, 'cockpit.log'), 'w')
-    original = sys.stdout
-    sys.stdout = Tee(sys.stdout, f)
     if app.is_running:
-    # if False:
-        app.send_message(sys.argv)
-        base.tray.hide()
+        # the running instance holds the lock but didn't take the message
+        QMessageBox.critical(None, 'Already running', 'Another cockpit is running but not responding.', QMessageBox.Ok)
+        sys.exit(1)
     else:
+        with profiler.span('startup.base'):
+            base = DRBase()
+        app.new_connection.connect(base.browser_or_cockpit)
+        app.setQuitOnLastWindowClosed(False)
+        # only the primary instance owns cockpit.log, a second launch must not rotate it away
+        log_path = os.path.join(BASE_PATH, 'cockpit.log')
+        rotate_file(log_path)
+        f = open(log_path, 'w')
+        writer = LogWriter()
+        app.aboutToQuit.connect(writer.close)
+        original, original_err = sys.stdout, sys.stderr
+        sys.stdout = Tee(writer, sys.stdout, f)
+        sys.stderr = Tee(writer, sys.stderr, f)
+        profiler.open(os.path.join(base.settings.get_log_dir(), 'timings.jsonl'))
+        # the first pass of the event loop is when the tray icon actually appears
+        QTimer.singleShot(0, lambda: startup.end())
         if len(sys.argv) > 1 and sys.argv[1] == 'tray':
             base.browser_waiting = False
         app.setWindowIcon(QIcon(os.path.join(BASE_PATH, 'icons/awecode/16.png')))
         ret = app.exec_()
         app.deleteLater()
+        writer.close()
         f.close()
-        sys.stdout = original
+        sys.stdout, sys.stderr = original, original_err
         sys.exit(ret)
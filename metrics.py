@@ -0,0 +1,105 @@
+import re
+import time
+from collections import deque
+
+# matches the request part of runserver/gunicorn/uvicorn access lines, e.g.
+# [17/Oct/2016 10:00:00] "GET /sales/ HTTP/1.1" 200 5321
+# the size, a trailing duration ("12.5ms" or "0.0125") and a reason phrase are optional
+ACCESS_LINE = re.compile(r'"(?P<method>[A-Z]+) (?P<path>\S+) HTTP/[\d.]+" (?P<status>[1-5]\d\d)'
+                         r'(?: (?P<size>\d+|-))?(?: (?P<duration>\d+(?:\.\d+)?)(?P<unit>ms|s)?)?'
+                         r'(?:[ \t]+[A-Za-z][\w \t]*)?[ \t]*$', re.M)
+
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+
+class Bucket(object):
+    __slots__ = ('index', 'count', 'statuses', 'bytes', 'durations')
+
+    def __init__(self, index):
+        self.index = index
+        self.count = 0
+        self.statuses = dict.fromkeys(STATUS_CLASSES, 0)
+        self.bytes = 0
+        self.durations = []
+
+
+class RequestMetrics(object):
+    """
+    Rolling request statistics fed with batches of service output lines.
+
+    Requests are counted in fixed `resolution` second buckets, only the last `buckets` of them
+    are kept, so memory is bounded no matter how long the service runs.
+    """
+    resolution = 1
+    buckets = 300
+
+    def __init__(self, resolution=None, buckets=None):
+        self.resolution = resolution or self.resolution
+        self.window = deque(maxlen=buckets or self.buckets)
+        self.total = 0
+
+    def feed(self, lines, timestamp=None):
+        text = '\n'.join(lines)
+        # most batches are plain output, skip running the regex over them
+        if 'HTTP/' not in text:
+            return 0
+        bucket = self.bucket(timestamp or time.time())
+        found = 0
+        for match in ACCESS_LINE.finditer(text):
+            found += 1
+            bucket.statuses[match.group('status')[0] + 'xx'] += 1
+            size = match.group('size')
+            if size and size != '-':
+                bucket.bytes += int(size)
+            duration = match.group('duration')
+            if duration:
+                duration = float(duration)
+                if match.group('unit') != 'ms':
+                    duration *= 1000
+                bucket.durations.append(duration)
+        bucket.count += found
+        self.total += found
+        return found
+
+    def bucket(self, timestamp):
+        index = int(timestamp // self.resolution)
+        if self.window and self.window[-1].index >= index:
+            return self.window[-1]
+        self.advance(index)
+        return self.window[-1]
+
+    def advance(self, index):
+        # fill the gap with empty buckets so every bucket in the window is one step apart
+        last = self.window[-1].index if self.window else index - 1
+        for i in range(max(last + 1, index - self.window.maxlen + 1), index + 1):
+            self.window.append(Bucket(i))
+
+    def recent(self, seconds, now=None):
+        self.advance(int((now or time.time()) // self.resolution))
+        n = min(len(self.window), max(1, int(seconds // self.resolution)))
+        return list(self.window)[-n:]
+
+    def series(self, seconds, now=None, field='count'):
+        if field in STATUS_CLASSES:
+            return [bucket.statuses[field] for bucket in self.recent(seconds, now)]
+        return [getattr(bucket, field) for bucket in self.recent(seconds, now)]
+
+    def requests_per_second(self, seconds=10, now=None):
+        buckets = self.recent(seconds, now)
+        return sum(bucket.count for bucket in buckets) / float(len(buckets) * self.resolution)
+
+    def status_counts(self, seconds=60, now=None):
+        counts = dict.fromkeys(STATUS_CLASSES, 0)
+        for bucket in self.recent(seconds, now):
+            for key, value in bucket.statuses.items():
+                counts[key] += value
+        return counts
+
+    def bytes_sent(self, seconds=60, now=None):
+        return sum(bucket.bytes for bucket in self.recent(seconds, now))
+
+    def percentiles(self, seconds=60, now=None, points=(50, 95, 99)):
+        durations = sorted(d for bucket in self.recent(seconds, now) for d in bucket.durations)
+        if not durations:
+            return None
+        return dict((p, durations[min(len(durations) - 1, int(len(durations) * p / 100.0))]) for p in points)
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+
+from utils import rotate_file
+
+
+class Span(object):
+    def __init__(self, profiler, name, fields):
+        self.profiler = profiler
+        self.name = name
+        self.fields = fields
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def end(self, **fields):
+        # a span can be closed from more than one place, only the first one counts
+        if self.duration is not None:
+            return self.duration
+        self.duration = time.perf_counter() - self.start
+        self.fields.update(fields)
+        self.profiler.record(self)
+        return self.duration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.fields['error'] = exc_type.__name__
+        self.end()
+
+
+class Profiler(object):
+    """
+    Named timing spans written as JSON lines to a size rotated journal.
+
+    Spans recorded before `open()` is called (the journal location comes from the settings) are
+    kept in memory and written out once the journal is opened.
+    """
+    max_bytes = 1024 * 1024
+    count = 3
+
+    def __init__(self):
+        self.path = None
+        self.pending = []
+        self.lock = threading.Lock()
+        self.session = int(time.time() * 1000)
+
+    def open(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            self.path = path
+            pending, self.pending = self.pending, []
+            self.write(pending)
+
+    def span(self, name, **fields):
+        return Span(self, name, fields)
+
+    def record(self, span):
+        entry = {'name': span.name, 'ts': round(span.started_at, 3), 'ms': round(span.duration * 1000, 2),
+                 'session': self.session}
+        if span.fields:
+            entry['fields'] = span.fields
+        with self.lock:
+            if self.path:
+                self.write([entry])
+            else:
+                self.pending.append(entry)
+
+    def write(self, entries):
+        if not entries:
+            return
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                rotate_file(self.path, self.count)
+            with open(self.path, 'a') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, default=str) + '\n')
+        except OSError:
+            pass
+
+    def entries(self):
+        # oldest first, across the rotated files
+        if not self.path:
+            return list(self.pending)
+        paths = ['%s.%d' % (self.path, i) for i in range(self.count, 0, -1)] + [self.path]
+        entries = []
+        for path in paths:
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            entries.append(json.loads(line))
+                        except ValueError:
+                            continue
+            except OSError:
+                continue
+        return entries
+
+    def summary(self):
+        durations = {}
+        for entry in self.entries():
+            durations.setdefault(entry['name'], []).append(entry['ms'])
+        rows = []
+        for name, values in sorted(durations.items()):
+            ordered = sorted(values)
+            rows.append({'name': name, 'count': len(values), 'last': values[-1],
+                         'median': ordered[len(ordered) // 2],
+                         'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 'max': ordered[-1]})
+        return rows
+
+    def last_session(self, prefix=''):
+        entries = [entry for entry in self.entries() if entry.get('session') == self.session]
+        return [entry for entry in entries if entry['name'].startswith(prefix)]
+
+
+profiler = Profiler()
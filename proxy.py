@@ -0,0 +1,367 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer', 'upgrade', 'expect'}
+MAX_HEAD = 64 * 1024
+CHUNK = 64 * 1024
+
+
+class ProxyError(Exception):
+    pass
+
+
+class Message(object):
+    def __init__(self, head):
+        lines = head.decode('latin-1').split('\r\n')
+        self.start_line = lines[0]
+        self.headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            if line[0] in ' \t' and self.headers:
+                name, value = self.headers[-1]
+                self.headers[-1] = (name, value + ' ' + line.strip())
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise ProxyError('Malformed header line')
+            self.headers.append((name.strip(), value.strip()))
+
+    def get(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def values(self, name):
+        name = name.lower()
+        return [value for key, value in self.headers if key.lower() == name]
+
+    def tokens(self, name):
+        # repeated headers are the same as one comma separated list
+        return [token.strip().lower() for token in ','.join(self.values(name)).split(',') if token.strip()]
+
+    def is_chunked(self):
+        return 'chunked' in self.tokens('transfer-encoding')
+
+    def content_length(self):
+        values = set(self.tokens('content-length'))
+        if not values:
+            return None
+        if len(values) > 1 or not all(value.isdigit() for value in values):
+            raise ProxyError('Invalid Content-Length')
+        return int(values.pop())
+
+    def check_request_framing(self):
+        # RFC 7230 3.3.3, a request the backend could delimit differently than we do is refused, it is
+        # how requests get smuggled past the proxy
+        encodings = self.tokens('transfer-encoding')
+        if encodings and (encodings[-1] != 'chunked' or self.values('content-length')):
+            raise ProxyError('Ambiguous message framing')
+        self.content_length()
+
+    def forward_headers(self, extra=()):
+        drop = HOP_BY_HOP | set(self.tokens('connection')) | {'content-length'}
+        lines = [self.start_line]
+        lines.extend('%s: %s' % (name, value) for name, value in self.headers if name.lower() not in drop)
+        # a single Content-Length, and none next to Transfer-Encoding, which takes precedence
+        if not self.values('transfer-encoding') and self.content_length() is not None:
+            lines.append('Content-Length: %d' % self.content_length())
+        lines.extend('%s: %s' % item for item in extra)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def read_head(reader):
+    try:
+        return await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise ProxyError('Connection closed in the middle of a message head')
+        return None
+    except asyncio.LimitOverrunError:
+        raise ProxyError('Message head too large')
+
+
+async def relay_body(reader, writer, message, until_eof=False):
+    if message.is_chunked():
+        # pass chunked bodies through untouched, only parsing enough to find the end
+        while True:
+            size_line = await reader.readuntil(b'\r\n')
+            writer.write(size_line)
+            size = int(size_line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                while True:
+                    trailer = await reader.readuntil(b'\r\n')
+                    writer.write(trailer)
+                    if trailer == b'\r\n':
+                        break
+                break
+            writer.write(await reader.readexactly(size + 2))
+            await writer.drain()
+        await writer.drain()
+        return
+    remaining = message.content_length()
+    if remaining is None and not until_eof:
+        return
+    while remaining is None or remaining > 0:
+        data = await reader.read(CHUNK if remaining is None else min(CHUNK, remaining))
+        if not data:
+            if remaining is None:
+                break
+            raise ProxyError('Connection closed in the middle of a body')
+        writer.write(data)
+        await writer.drain()
+        if remaining is not None:
+            remaining -= len(data)
+
+
+class Backend(object):
+    max_idle = 16
+    retry_after = 5
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.in_flight = 0
+        self.draining = False
+        self.down_until = 0
+        self.idle = deque()
+
+    def __repr__(self):
+        return 'Backend(%s:%d)' % (self.host, self.port)
+
+    def available(self):
+        return not self.draining and self.down_until <= time.monotonic()
+
+    async def acquire(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            # the backend may have closed it while it sat in the pool
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port, limit=MAX_HEAD)
+        except OSError:
+            self.down_until = time.monotonic() + self.retry_after
+            raise
+        return reader, writer, False
+
+    def release(self, conn, reusable):
+        reader, writer = conn
+        if reusable and not self.draining and len(self.idle) < self.max_idle:
+            self.idle.append(conn)
+        else:
+            writer.close()
+
+    def close_idle(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+class ReverseProxy(object):
+    """
+    HTTP/1.1 reverse proxy running its own asyncio loop on a background thread.
+
+    Requests go to the available backend with the fewest requests in flight, upstream connections
+    are kept alive and pooled per backend. `static` may be set to an object with an async
+    `handle(message, reader, writer)` returning True when it served the request itself.
+    """
+    connect_timeout = 5
+
+    def __init__(self, host, port, backends=()):
+        self.host = host
+        self.port = port
+        self.backends = list(backends)
+        self.static = None
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.error = None
+
+    # thread-safe control, called from the GUI thread
+
+    def start(self):
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(started,), name='reverse-proxy', daemon=True)
+        self.thread.start()
+        started.wait()
+        if self.error:
+            raise self.error
+
+    def run(self, started):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle_client, self.host, self.port, limit=MAX_HEAD))
+        except OSError as e:
+            self.error = e
+            started.set()
+            self.loop.close()
+            return
+        started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            for backend in self.backends:
+                backend.close_idle()
+            self.loop.close()
+
+    def stop(self):
+        if self.thread and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def is_running(self):
+        return bool(self.thread and self.thread.is_alive())
+
+    def set_backends(self, backends):
+        if self.loop and self.is_running():
+            self.loop.call_soon_threadsafe(self.swap_backends, list(backends))
+        else:
+            self.swap_backends(list(backends))
+
+    def swap_backends(self, backends):
+        for backend in self.backends:
+            if backend not in backends:
+                backend.draining = True
+                backend.close_idle()
+        for backend in backends:
+            # a server that left Ready keeps its Backend and comes back with it
+            backend.draining = False
+            backend.down_until = 0
+        self.backends = backends
+
+    # request handling, runs on the proxy loop
+
+    def choose(self, exclude=()):
+        candidates = [backend for backend in self.backends if backend.available() and backend not in exclude]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: backend.in_flight)
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        client_ip = peer[0] if peer else ''
+        try:
+            while True:
+                head = await read_head(reader)
+                if head is None:
+                    break
+                request = Message(head)
+                parts = request.start_line.split(' ')
+                if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+                    raise ProxyError('Malformed request line')
+                method, version = parts[0], parts[2]
+                request.check_request_framing()
+                if request.get('expect', '').lower() == '100-continue':
+                    writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                connection = request.tokens('connection')
+                keep_alive = 'keep-alive' in connection if version == 'HTTP/1.0' else 'close' not in connection
+                if self.static and await self.static.handle(request, reader, writer):
+                    keep_alive = keep_alive and not request.get('content-length') and not request.is_chunked()
+                else:
+                    keep_alive = await self.forward(request, method, client_ip, reader, writer) and keep_alive
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ProxyError:
+            self.send_error(writer, 400, 'Bad Request')
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except asyncio.CancelledError:
+            # the proxy is shutting down
+            pass
+        finally:
+            writer.close()
+
+    def send_error(self, writer, status, reason):
+        if writer.is_closing():
+            return
+        body = ('%d %s\n' % (status, reason)).encode()
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                      % (status, reason, len(body))).encode('latin-1') + body)
+
+    async def forward(self, request, method, client_ip, reader, writer):
+        forwarded_for = request.get('x-forwarded-for')
+        extra = [('X-Forwarded-For', forwarded_for + ', ' + client_ip if forwarded_for else client_ip),
+                 ('X-Forwarded-Proto', 'http'), ('Connection', 'keep-alive')]
+        head = request.forward_headers(extra)
+        has_body = request.is_chunked() or bool(request.content_length())
+        tried = []
+        attempts = 0
+        while True:
+            backend = self.choose(tried)
+            attempts += 1
+            if backend is None or attempts > len(self.backends) + 2:
+                if tried:
+                    self.send_error(writer, 502, 'Bad Gateway')
+                else:
+                    self.send_error(writer, 503, 'Service Unavailable')
+                return False
+            backend.in_flight += 1
+            pooled = False
+            conn = None
+            try:
+                upstream_reader, upstream_writer, pooled = await asyncio.wait_for(backend.acquire(), self.connect_timeout)
+                conn = upstream_reader, upstream_writer
+                upstream_writer.write(head)
+                if has_body:
+                    await relay_body(reader, upstream_writer, request)
+                await upstream_writer.drain()
+                response_head = await read_head(upstream_reader)
+                if response_head is None:
+                    raise ConnectionResetError('Backend closed the connection')
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ProxyError):
+                backend.in_flight -= 1
+                if conn:
+                    conn[1].close()
+                # a body that has been streamed can't be replayed, anything else can go to another backend
+                if has_body:
+                    self.send_error(writer, 502, 'Bad Gateway')
+                    return False
+                if not pooled:
+                    # a pooled connection may just have gone stale, so only give up on the backend after a fresh one failed
+                    tried.append(backend)
+                continue
+            try:
+                return await self.relay_response(method, response_head, upstream_reader, writer, backend, conn)
+            finally:
+                backend.in_flight -= 1
+
+    async def relay_response(self, method, response_head, upstream_reader, writer, backend, conn):
+        response = Message(response_head)
+        status = response.start_line.split(' ')[1] if ' ' in response.start_line else ''
+        while status.startswith('1'):
+            # interim responses (100 Continue) go straight through, the real one follows
+            writer.write(response_head)
+            response_head = await read_head(upstream_reader)
+            if response_head is None:
+                backend.release(conn, False)
+                return False
+            response = Message(response_head)
+            status = response.start_line.split(' ')[1] if ' ' in response.start_line else ''
+        no_body = method == 'HEAD' or status in ('204', '304')
+        delimited = no_body or response.is_chunked() or response.content_length() is not None
+        upstream_keep_alive = delimited and 'close' not in response.tokens('connection') and \
+            not response.start_line.startswith('HTTP/1.0')
+        extra = [('Connection', 'keep-alive' if delimited else 'close')]
+        writer.write(response.forward_headers(extra))
+        try:
+            if not no_body:
+                await relay_body(upstream_reader, writer, response, until_eof=not delimited)
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, ProxyError):
+            backend.release(conn, False)
+            raise ConnectionResetError('Relaying the response failed')
+        backend.release(conn, upstream_keep_alive)
+        return delimited
@@ -0,0 +1,265 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# one byte in front of every stored chunk says how it was compressed, so a repository written with
+# zstd can still be read back after switching machines, and the other way round
+ZSTD = b'Z'
+ZLIB = b'z'
+
+
+def compress(data, level=None):
+    if zstandard:
+        return ZSTD + zstandard.ZstdCompressor(level=level or 3).compress(data)
+    return ZLIB + zlib.compress(data, level or 6)
+
+
+def decompress(blob):
+    kind, data = blob[:1], blob[1:]
+    if kind == ZSTD:
+        if not zstandard:
+            raise IOError('The backup was compressed with zstd, install the zstandard package to read it.')
+        return zstandard.ZstdDecompressor().decompress(data)
+    if kind == ZLIB:
+        return zlib.decompress(data)
+    raise IOError('Unknown chunk format.')
+
+
+def write_atomic(path, data):
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+class Snapshot(object):
+    def __init__(self, path, manifest):
+        self.path = path
+        self.id = os.path.basename(path)[:-len('.json')]
+        self.manifest = manifest
+        self.created = manifest['created']
+        self.size = manifest['size']
+        self.sha256 = manifest['sha256']
+        self.source = manifest.get('source', '')
+        self.chunks = manifest['chunks']
+
+    def __repr__(self):
+        return 'Snapshot(%s)' % self.id
+
+
+class Repository(object):
+    """
+    Backup history stored as deduplicated, compressed chunks plus one manifest per snapshot.
+
+    Snapshots are cut into fixed size chunks. SQLite rewrites whole pages in place, so fixed
+    boundaries that are a multiple of the page size line up with what changed and content defined
+    chunking wouldn't find more to share. A chunk is stored once under its sha256, so a backup
+    only writes the chunks that changed since any earlier snapshot.
+
+        <root>/chunks/ab/abcdef...   compressed chunk
+        <root>/snapshots/<id>.json   manifest
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, root, workers=None):
+        self.root = root
+        self.chunks_dir = os.path.join(root, 'chunks')
+        self.snapshots_dir = os.path.join(root, 'snapshots')
+        self.workers = workers or os.cpu_count() or 2
+
+    def init(self):
+        os.makedirs(self.chunks_dir, exist_ok=True)
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self.chunk_path(digest))
+
+    def put_chunk(self, digest, data):
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        blob = compress(data)
+        write_atomic(path, blob)
+        return len(blob)
+
+    def get_chunk(self, digest):
+        with open(self.chunk_path(digest), 'rb') as f:
+            data = decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise IOError('Chunk %s is corrupt.' % digest)
+        return data
+
+    def store(self, path, source=None, progress=None, extra=None, throttle=None):
+        """Add the file at `path` as a new snapshot and return it."""
+        self.init()
+        total = os.path.getsize(path)
+        whole = hashlib.sha256()
+        chunks = []
+        stats = {'chunks': 0, 'new_chunks': 0, 'written': 0}
+        done = 0
+        started = time.time()
+        # hashing stays in order on this thread, only new chunks go to the pool to be compressed
+        with ThreadPoolExecutor(max_workers=self.workers) as pool, open(path, 'rb') as f:
+            queued = set()
+            pending = deque()
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                if throttle:
+                    throttle(len(data))
+                whole.update(data)
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append(digest)
+                stats['chunks'] += 1
+                if digest not in queued and not self.has_chunk(digest):
+                    queued.add(digest)
+                    stats['new_chunks'] += 1
+                    pending.append(pool.submit(self.put_chunk, digest, data))
+                    # bound the chunks held in memory on a first backup of a large database
+                    while len(pending) > self.workers * 2:
+                        stats['written'] += pending.popleft().result()
+                done += len(data)
+                if progress:
+                    # may raise to abort, nothing is referenced by a manifest before the end
+                    progress(done, total)
+            for future in pending:
+                stats['written'] += future.result()
+        manifest = {'created': started, 'duration': time.time() - started, 'size': total,
+                    'sha256': whole.hexdigest(), 'source': source or path, 'chunk_size': self.chunk_size,
+                    'chunks': chunks, 'stats': stats}
+        if extra:
+            manifest.update(extra)
+        snapshot_id = time.strftime('%Y%m%d-%H%M%S', time.localtime(started)) + '-%03d' % (started % 1 * 1000)
+        manifest_path = os.path.join(self.snapshots_dir, snapshot_id + '.json')
+        write_atomic(manifest_path, json.dumps(manifest).encode('utf-8'))
+        return Snapshot(manifest_path, manifest)
+
+    def snapshots(self):
+        """All snapshots, oldest first."""
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        snapshots = []
+        for name in sorted(os.listdir(self.snapshots_dir)):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.snapshots_dir, name)
+            try:
+                with open(path) as f:
+                    snapshots.append(Snapshot(path, json.load(f)))
+            except (OSError, ValueError, KeyError):
+                continue
+        return snapshots
+
+    def get(self, snapshot_id):
+        for snapshot in self.snapshots():
+            if snapshot.id == snapshot_id:
+                return snapshot
+        return None
+
+    def extract(self, snapshot, f, progress=None):
+        """Write the snapshot's data to the open file `f`, raising IOError if it doesn't match its sha256."""
+        whole = hashlib.sha256()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # chunks are decompressed a few ahead in parallel and written in order
+            pending = deque()
+            digests = iter(snapshot.chunks)
+            written = 0
+            while True:
+                for digest in digests:
+                    pending.append(pool.submit(self.get_chunk, digest))
+                    if len(pending) > self.workers * 2:
+                        break
+                if not pending:
+                    break
+                data = pending.popleft().result()
+                whole.update(data)
+                f.write(data)
+                written += 1
+                if progress:
+                    progress(written, len(snapshot.chunks))
+        if whole.hexdigest() != snapshot.sha256:
+            raise IOError('Restored data does not match the snapshot checksum.')
+
+    def restore(self, snapshot, destination, progress=None):
+        """Write the snapshot to `destination`, replaced atomically once the data checked out."""
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(destination)), prefix='.restore-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.extract(snapshot, f, progress)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(partial, destination)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return destination
+
+    def select_kept(self, keep_last=10, keep_daily=7, keep_weekly=4, now=None):
+        snapshots = self.snapshots()
+        kept = set(snapshot.id for snapshot in snapshots[-keep_last:]) if keep_last else set()
+        # newest snapshot of each of the last days/weeks that have one
+        for keep, period in ((keep_daily, '%Y-%m-%d'), (keep_weekly, '%Y-%W')):
+            seen = []
+            for snapshot in reversed(snapshots):
+                key = time.strftime(period, time.localtime(snapshot.created))
+                if key in seen:
+                    continue
+                if len(seen) >= keep:
+                    break
+                seen.append(key)
+                kept.add(snapshot.id)
+        return [snapshot for snapshot in snapshots if snapshot.id in kept]
+
+    def prune(self, keep_last=10, keep_daily=7, keep_weekly=4):
+        """Drop the snapshots the retention policy doesn't keep, then the chunks nothing uses any more."""
+        kept = self.select_kept(keep_last, keep_daily, keep_weekly)
+        kept_ids = set(snapshot.id for snapshot in kept)
+        removed = [snapshot for snapshot in self.snapshots() if snapshot.id not in kept_ids]
+        for snapshot in removed:
+            os.remove(snapshot.path)
+        if removed:
+            self.collect_garbage()
+        return removed
+
+    def collect_garbage(self):
+        used = set()
+        for snapshot in self.snapshots():
+            used.update(snapshot.chunks)
+        freed = 0
+        if not os.path.isdir(self.chunks_dir):
+            return freed
+        for prefix in os.listdir(self.chunks_dir):
+            directory = os.path.join(self.chunks_dir, prefix)
+            for name in os.listdir(directory):
+                if name not in used:
+                    path = os.path.join(directory, name)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+        return freed
+
+    def disk_usage(self):
+        total = 0
+        for directory, dirs, files in os.walk(self.root):
+            total += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+        return total
@@ -0,0 +1,67 @@
+import time
+
+# 7 is Sunday as well as 0
+FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def parse_field(value, low, high):
+    allowed = set()
+    for part in value.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError('Invalid step in "%s"' % value)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(x) for x in part.split('-', 1))
+        else:
+            start = end = int(part)
+            if step > 1:
+                end = high
+        if start < low or end > high or start > end:
+            raise ValueError('"%s" is out of range %d-%d' % (value, low, high))
+        allowed.update(range(start, end + 1, step))
+    return allowed
+
+
+class Cron(object):
+    """
+    Five field cron expression: minute hour day-of-month month day-of-week (0 is Sunday).
+
+    Fields take *, numbers, ranges (1-5), lists (1,15) and steps (*/15, 8-18/2). As in cron, when both
+    day fields are restricted a day matching either of them counts.
+    """
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('A cron expression needs five fields, got "%s"' % expression)
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_field(field, low, high) for field, (low, high) in zip(fields, FIELDS))
+        self.weekdays = set(day % 7 for day in weekdays)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def matches(self, timestamp):
+        t = time.localtime(timestamp)
+        if t.tm_min not in self.minutes or t.tm_hour not in self.hours or t.tm_mon not in self.months:
+            return False
+        day = t.tm_mday in self.days
+        # tm_wday counts from Monday
+        weekday = (t.tm_wday + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def due_between(self, start, end):
+        """Whether a matching minute falls in (start, end], only the minutes in between are tested."""
+        minute = int(start // 60 + 1) * 60
+        while minute <= end:
+            if self.matches(minute):
+                return True
+            minute += 60
+        return False
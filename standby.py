@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Warm standby server, run by the cockpit with the project's python from the project directory.
+# It sets up Django and loads the WSGI application, then waits for "host:port" on stdin and
+# starts serving straight away, so a start or restart doesn't pay for the imports.
+import os
+import sys
+import time
+
+READY = 'Cockpit standby ready'
+STALE_EXIT = 3
+
+
+def is_stale(since):
+    # code changed after we imported it, serving it would run the old version
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if path:
+            try:
+                if os.stat(path).st_mtime > since:
+                    return True
+            except OSError:
+                continue
+    return False
+
+
+def main():
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'runserver'
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    sys.path.insert(0, os.getcwd())
+    imported_at = time.time()
+
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.core.servers.basehttp import get_internal_wsgi_application
+    application = get_internal_wsgi_application()
+    if backend == 'runserver' and settings.DEBUG and 'django.contrib.staticfiles' in settings.INSTALLED_APPS:
+        # what runserver would do
+        from django.contrib.staticfiles.handlers import StaticFilesHandler
+        application = StaticFilesHandler(application)
+    print(READY, flush=True)
+
+    line = sys.stdin.readline().strip()
+    if not line:
+        # the cockpit went away or discarded us
+        return
+    if is_stale(imported_at):
+        print('Project changed while in standby, exiting.', flush=True)
+        sys.exit(STALE_EXIT)
+    host, port = line.rsplit(':', 1)
+    if backend == 'waitress':
+        from waitress import serve
+        serve(application, listen=host + ':' + port, threads=threads)
+    else:
+        from django.core.servers.basehttp import run
+        run(host, int(port), application, threading=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import asyncio
+import mimetypes
+import os
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+from urllib.parse import unquote
+
+SENDFILE_MIN = 64 * 1024
+
+
+class FileCache(object):
+    """LRU of small file contents, bounded by the total number of bytes held."""
+    max_bytes = 32 * 1024 * 1024
+    max_file = 256 * 1024
+
+    def __init__(self, max_bytes=None, max_file=None):
+        self.max_bytes = max_bytes or self.max_bytes
+        self.max_file = max_file or self.max_file
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, path, etag):
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        if entry[0] != etag:
+            self.discard(path)
+            return None
+        self.entries.move_to_end(path)
+        return entry[1]
+
+    def put(self, path, etag, data):
+        if len(data) > self.max_file:
+            return
+        self.discard(path)
+        self.entries[path] = (etag, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, path):
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.size -= len(entry[1])
+
+
+def parse_range(value, size):
+    # only single byte ranges are supported, anything else gets the whole file
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    start, sep, end = value[6:].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+class StaticFiles(object):
+    """
+    Serves files under the configured url prefixes straight from disk for the reverse proxy,
+    so static and media requests never reach the Django process.
+    """
+
+    def __init__(self, mappings, cache=None):
+        # longest prefix first so /static/admin/ could map somewhere else than /static/
+        self.mappings = sorted(((prefix, os.path.realpath(root)) for prefix, root in mappings),
+                               key=lambda mapping: -len(mapping[0]))
+        self.cache = cache or FileCache()
+
+    def resolve(self, target):
+        path = unquote(target.split('?', 1)[0].split('#', 1)[0])
+        for prefix, root in self.mappings:
+            if path.startswith(prefix):
+                full_path = os.path.realpath(os.path.join(root, path[len(prefix):].lstrip('/')))
+                # refuse anything that escapes the root through .. or symlinks
+                if os.path.commonpath([root, full_path]) != root:
+                    return None
+                return full_path
+        return None
+
+    async def handle(self, request, reader, writer):
+        parts = request.start_line.split(' ')
+        if len(parts) != 3 or parts[0] not in ('GET', 'HEAD'):
+            return False
+        path = self.resolve(parts[1])
+        if not path:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if not os.path.isfile(path):
+            return False
+        etag = '"%x-%x"' % (stat.st_size, stat.st_mtime_ns)
+        headers = [('ETag', etag), ('Last-Modified', formatdate(stat.st_mtime, usegmt=True)),
+                   ('Date', formatdate(time.time(), usegmt=True)), ('Accept-Ranges', 'bytes')]
+        if etag in [tag.strip() for tag in (request.get('if-none-match') or '').split(',')] or \
+                request.get('if-none-match', '').strip() == '*':
+            self.send(writer, '304 Not Modified', headers)
+            return True
+
+        size = stat.st_size
+        start, end = 0, size - 1
+        status = '200 OK'
+        byte_range = parse_range(request.get('range'), size) if request.get('if-range', etag) == etag else None
+        if byte_range is False:
+            self.send(writer, '416 Range Not Satisfiable', headers + [('Content-Range', 'bytes */%d' % size),
+                                                                      ('Content-Length', '0')])
+            return True
+        if byte_range:
+            start, end = byte_range
+            status = '206 Partial Content'
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+        length = max(0, end - start + 1)
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        headers += [('Content-Type', content_type), ('Content-Length', str(length))]
+        self.send(writer, status, headers)
+        if parts[0] == 'HEAD' or not length:
+            return True
+
+        data = self.cache.get(path, etag)
+        if data is None and size <= self.cache.max_file:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) == size:
+                self.cache.put(path, etag, data)
+        if data is not None:
+            writer.write(data[start:end + 1])
+            return True
+        await writer.drain()
+        with open(path, 'rb') as f:
+            if length >= SENDFILE_MIN:
+                # zero-copy where the platform has os.sendfile, asyncio falls back to reads otherwise
+                await asyncio.get_running_loop().sendfile(writer.transport, f, start, length)
+            else:
+                f.seek(start)
+                writer.write(f.read(length))
+        return True
+
+    def send(self, writer, status, headers):
+        lines = ['HTTP/1.1 ' + status] + ['%s: %s' % header for header in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
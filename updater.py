@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from repository import write_atomic
+
+
+def file_sha256(f, chunk=1024 * 1024):
+    digest = hashlib.sha256()
+    while True:
+        data = f.read(chunk)
+        if not data:
+            break
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class HashCache(object):
+    """sha256 of local files, reused while a file's size and mtime are unchanged."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry[:2] == key:
+            return entry[2]
+        with open(path, 'rb') as f:
+            digest = file_sha256(f)
+        with self.lock:
+            self.entries[path] = key + [digest]
+        return digest
+
+    def set(self, path, digest):
+        stat = os.stat(path)
+        with self.lock:
+            self.entries[path] = [stat.st_size, stat.st_mtime_ns, digest]
+
+    def forget(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock:
+            data = json.dumps(self.entries)
+        write_atomic(self.path, data.encode('utf-8'))
+
+
+class DeltaUpdate(object):
+    """
+    Applies an update archive to `project_path` by writing only what differs.
+
+    Files in the archive (below its single root folder) are hashed in parallel and compared with the
+    local files, whose hashes are cached by size and mtime in `<project>/.cockpit-update/`. Added and
+    changed files are written in place atomically, unchanged ones aren't touched, so their compiled
+    .pyc stays valid. Files the previous update installed that are gone from the archive are removed;
+    anything else in the project (databases, media, local settings) is never deleted.
+    """
+    state_dir = '.cockpit-update'
+
+    def __init__(self, archive, project_path, workers=None, progress=None):
+        self.archive = archive
+        self.project_path = project_path
+        self.workers = workers or os.cpu_count() or 2
+        self.progress = progress
+        self.state_path = os.path.join(project_path, self.state_dir)
+        self.cache = HashCache(os.path.join(self.state_path, 'hashes.json'))
+        self.local = threading.local()
+        self.opened = []
+
+    def zip_file(self):
+        # a ZipFile can't be read from several threads at once, each worker opens its own
+        if not hasattr(self.local, 'zip_file'):
+            self.local.zip_file = zipfile.ZipFile(self.archive)
+            self.opened.append(self.local.zip_file)
+        return self.local.zip_file
+
+    def close(self):
+        while self.opened:
+            self.opened.pop().close()
+        self.local = threading.local()
+
+    def members(self):
+        with zipfile.ZipFile(self.archive) as zip_file:
+            infos = [info for info in zip_file.infolist() if info.filename]
+        roots = set(info.filename.split('/', 1)[0] for info in infos)
+        if len(roots) != 1 or any('/' not in info.filename for info in infos):
+            raise IOError("The update archive doesn't have one and only one root folder.")
+        members = {}
+        for info in infos:
+            if info.is_dir():
+                continue
+            name = posixpath.normpath(info.filename.split('/', 1)[1])
+            if name.startswith('..') or posixpath.isabs(name):
+                raise IOError('Unsafe path in the update archive: %s' % info.filename)
+            members[name] = info.filename
+        return members
+
+    def archive_hash(self, member):
+        with self.zip_file().open(member) as f:
+            return file_sha256(f)
+
+    def local_path(self, name):
+        return os.path.join(self.project_path, *name.split('/'))
+
+    def local_hash(self, name):
+        path = self.local_path(name)
+        return self.cache.get(path) if os.path.isfile(path) else None
+
+    def load_installed(self):
+        try:
+            with open(os.path.join(self.state_path, 'installed.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def plan(self):
+        """Compare the archive with the project, returns {'added': [...], 'changed': [...], ...}."""
+        members = self.members()
+        installed = self.load_installed()
+        names = sorted(members)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                incoming = dict(zip(names, pool.map(lambda name: self.archive_hash(members[name]), names)))
+                current = dict(zip(names, pool.map(self.local_hash, names)))
+        finally:
+            self.close()
+        plan = {'added': [], 'changed': [], 'unchanged': [], 'removed': [], 'members': members,
+                'hashes': incoming}
+        for name in names:
+            if current[name] is None:
+                plan['added'].append(name)
+            elif current[name] != incoming[name]:
+                plan['changed'].append(name)
+            else:
+                plan['unchanged'].append(name)
+        # only what an earlier update put there, and only if it wasn't edited locally since
+        for name, digest in installed.items():
+            if name not in members and self.local_hash(name) == digest:
+                plan['removed'].append(name)
+        return plan
+
+    def write(self, name, member, digest):
+        path = self.local_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.update-')
+        try:
+            with os.fdopen(fd, 'wb') as f, self.zip_file().open(member) as src:
+                shutil.copyfileobj(src, f, 1024 * 1024)
+            if os.path.exists(path):
+                shutil.copymode(path, partial)
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        self.cache.set(path, digest)
+        self.clean_pyc(path)
+
+    def remove(self, name):
+        path = self.local_path(name)
+        os.remove(path)
+        self.cache.forget(path)
+        self.clean_pyc(path)
+        self.prune_directories(os.path.dirname(path))
+
+    def prune_directories(self, directory):
+        # parents the removal left empty, up to the project itself. A __pycache__ emptied by clean_pyc
+        # counts as empty too.
+        root = os.path.abspath(self.project_path)
+        directory = os.path.abspath(directory)
+        while directory != root and directory.startswith(root + os.sep):
+            cache_dir = os.path.join(directory, '__pycache__')
+            if os.path.isdir(cache_dir) and not os.listdir(cache_dir):
+                os.rmdir(cache_dir)
+            if os.listdir(directory):
+                break
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+    def clean_pyc(self, path):
+        # only the compiled versions of the modules that changed, the rest stay warm
+        if not path.endswith('.py'):
+            return
+        directory, module = os.path.split(path[:-len('.py')])
+        if os.path.exists(path + 'c'):
+            os.remove(path + 'c')
+        cache_dir = os.path.join(directory, '__pycache__')
+        if os.path.isdir(cache_dir):
+            for name in os.listdir(cache_dir):
+                if name.startswith(module + '.') and name.endswith('.pyc'):
+                    os.remove(os.path.join(cache_dir, name))
+
+    def apply(self, plan=None):
+        try:
+            plan = plan or self.plan()
+            members, hashes = plan['members'], plan['hashes']
+            writes = plan['added'] + plan['changed']
+            total = len(writes) + len(plan['removed'])
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                written = pool.map(lambda name: self.write(name, members[name], hashes[name]), writes)
+                for done, _ in enumerate(written, 1):
+                    if self.progress:
+                        self.progress(done, total)
+            for done, name in enumerate(plan['removed'], len(writes) + 1):
+                self.remove(name)
+                if self.progress:
+                    self.progress(done, total)
+        finally:
+            self.close()
+            # whatever was written is in the cache already, keep it warm for the next update
+            self.cache.save()
+        write_atomic(os.path.join(self.state_path, 'installed.json'), json.dumps(plan['hashes']).encode('utf-8'))
+        return plan
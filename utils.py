@@ -4,9 +4,11 @@ from PyQt5.QtCore import pyqtRemoveInputHook
 import os
 import sys
 import subprocess
-import shutil
-from psutil import process_iter
-from psutil import AccessDenied
+import socket
+import threading
+import time
+from psutil import process_iter, net_connections, Process
+from psutil import AccessDenied, NoSuchProcess, CONN_LISTEN
 from signal import SIGTERM  # or SIGKILL
 from http.cookiejar import CookieJar, Cookie
 from pdb import set_trace
@@ -43,19 +45,6 @@ def open_file(filename):
         subprocess.call([opener, filename])
 
 
-def move_files(src, dst):
-    for src_dir, dirs, files in os.walk(src):
-        dst_dir = src_dir.replace(src, dst, 1)
-        if not os.path.exists(dst_dir):
-            os.makedirs(dst_dir)
-        for file_ in files:
-            src_file = os.path.join(src_dir, file_)
-            dst_file = os.path.join(dst_dir, file_)
-            if os.path.exists(dst_file):
-                os.remove(dst_file)
-            shutil.move(src_file, dst_dir)
-
-
 def call_command(param, cwd=None):
     if sys.platform == "win32":
         param.insert(0, 'cmd.exe')
@@ -86,43 +75,154 @@ def clean_pyc(folder):
         os.remove(filename)
 
 
-def free_port(port):
-    for proc in process_iter():
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+        size /= 1024.0
+
+
+def rotate_file(path, count=5):
+    if not os.path.exists(path):
+        return
+    for i in range(count - 1, 0, -1):
+        older = '%s.%d' % (path, i)
+        if os.path.exists(older):
+            os.replace(older, '%s.%d' % (path, i + 1))
+    os.replace(path, path + '.1')
+
+
+class PortIndex(object):
+    """
+    Snapshot of which process owns which local inet port, built from a single
+    system-wide connection listing and reused for `ttl` seconds.
+    """
+    ttl = 1.0
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl or self.ttl
+        self.ports = {}
+        self.built = None
+
+    def refresh(self):
+        ports = {}
         try:
-            for conns in proc.connections(kind='inet'):
-                if conns.laddr[1] == int(port):
-                    proc.send_signal(SIGTERM)  # or SIGKILL
-                    continue
+            for conn in net_connections(kind='inet'):
+                if conn.laddr:
+                    ports.setdefault(conn.laddr[1], []).append((conn.pid, conn.status))
         except AccessDenied:
-            continue
+            # net_connections() needs root on macOS, fall back to one pass over the processes we may inspect
+            for proc in process_iter():
+                try:
+                    for conn in proc.connections(kind='inet'):
+                        if conn.laddr:
+                            ports.setdefault(conn.laddr[1], []).append((proc.pid, conn.status))
+                except (AccessDenied, NoSuchProcess):
+                    continue
+        self.ports = ports
+        self.built = time.monotonic()
 
+    def invalidate(self):
+        self.built = None
 
-def process_on_port(port):
-    for proc in process_iter():
+    def get(self, port):
+        if self.built is None or time.monotonic() - self.built > self.ttl:
+            self.refresh()
+        return self.ports.get(int(port), [])
+
+    def pids(self, port):
+        return [pid for pid, status in self.get(port) if pid]
+
+    def owner_pid(self, port):
+        entries = self.get(port)
+        # prefer the listening socket's owner over clients connected from that port
+        for pid, status in entries:
+            if pid and status == CONN_LISTEN:
+                return pid
+        for pid, status in entries:
+            if pid:
+                return pid
+
+    def owner(self, port):
+        pid = self.owner_pid(port)
+        if pid:
+            try:
+                return Process(pid)
+            except NoSuchProcess:
+                return None
+
+    def is_listening(self, port):
+        return any(status == CONN_LISTEN for pid, status in self.get(port))
+
+    def cmdline(self, port):
+        proc = self.owner(port)
+        if proc:
+            try:
+                return proc.cmdline()
+            except (AccessDenied, NoSuchProcess):
+                return None
+
+    def matches(self, port, cmdline):
+        proc_cmdline = self.cmdline(port)
+        if not proc_cmdline or not cmdline:
+            return False
+        return os.path.normpath(proc_cmdline[0]) == os.path.normpath(cmdline[0]) and proc_cmdline[1:] == cmdline[1:]
+
+
+port_index = PortIndex()
+
+
+def free_port(port):
+    for pid in set(port_index.pids(port)):
+        if pid == os.getpid():
+            # the cockpit's own proxy, stopping the service releases it
+            continue
         try:
-            for conns in proc.connections(kind='inet'):
-                if conns.laddr[1] == int(port):
-                    return proc
-                    continue
-        except AccessDenied:
+            Process(pid).send_signal(SIGTERM)  # or SIGKILL
+        except (AccessDenied, NoSuchProcess):
             continue
+    port_index.invalidate()
 
 
-def confirm_process_on_port(port, cmdline):
-    for proc in process_iter():
+def find_free_port(host='127.0.0.1'):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def kill_process_tree(pid):
+    try:
+        parent = Process(pid)
+        procs = parent.children(recursive=True) + [parent]
+    except NoSuchProcess:
+        return
+    for proc in procs:
         try:
-            for conns in proc.connections(kind='inet'):
-                if conns.laddr[1] == int(port):
-                    proc_cmdline = proc.cmdline()
-                    if proc_cmdline and cmdline:
-                        proc_exe_path = os.path.normpath(proc_cmdline.pop(0))
-                        exe_path = os.path.normpath(cmdline.pop(0))
-                        if proc_cmdline == cmdline and proc_exe_path == exe_path:
-                            return True
-                    continue
-        except AccessDenied:
+            proc.kill()
+        except (AccessDenied, NoSuchProcess):
             continue
-    return False
+
+
+def lower_thread_priority():
+    # background work shouldn't compete with the served app, linux has per thread nice and io priority
+    if not sys.platform.startswith('linux'):
+        return
+    from psutil import IOPRIO_CLASS_IDLE
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 10)
+        Process(tid).ionice(IOPRIO_CLASS_IDLE)
+    except (OSError, AccessDenied, NoSuchProcess):
+        pass
+
+
+def process_on_port(port):
+    return port_index.owner(port)
+
+
+def confirm_process_on_port(port, cmdline):
+    return port_index.matches(port, cmdline)
+
 
 def to_py_cookie(QtCookie):
         port = None